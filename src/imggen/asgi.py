@@ -0,0 +1,257 @@
+import asyncio
+import json
+import os
+from urllib.parse import parse_qsl
+
+import metrics
+import profiler
+from config import env_int
+from generator import (
+    PROFILED_ROUTES,
+    RENDER_TIMEOUT,
+    parse_output_options,
+    render_engine,
+    response_parts,
+)
+from render_engine import QueueFullError
+from renderer import cache_stats, generate_steps, parse_board, score_board
+
+# Same routes and responses as the Flask app, served from one event loop so slow
+# clients only hold a coroutine; rendering still runs on the render engine
+MAX_BODY_BYTES = env_int("IMGGEN_MAX_BODY_BYTES", 16 * 1024 * 1024)
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+async def read_body(receive):
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ConnectionResetError("Client disconnected.")
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if MAX_BODY_BYTES and size > MAX_BODY_BYTES:
+            msg = f"Request body too large (> {MAX_BODY_BYTES} bytes)."
+            raise HTTPError(413, msg)
+        chunks.append(chunk)
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+
+def query_args(scope):
+    # First value wins, like Flask's request.args.get
+    args = {}
+    for key, value in parse_qsl(scope.get("query_string", b"").decode("latin-1")):
+        args.setdefault(key, value)
+    return args
+
+
+async def send_response(send, status, body, content_type, headers=None):
+    raw_headers = [
+        (b"content-type", content_type.encode("latin-1")),
+        (b"content-length", str(len(body)).encode("latin-1")),
+    ]
+    for name, value in (headers or {}).items():
+        raw_headers.append((name.lower().encode("latin-1"), value.encode("latin-1")))
+    await send(
+        {"type": "http.response.start", "status": status, "headers": raw_headers}
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_json(send, status, body, headers=None):
+    data = json.dumps(body).encode()
+    await send_response(send, status, data, "application/json", headers)
+
+
+async def render(fn, *args):
+    if render_engine.processes == 0:
+        # The inline engine renders on the calling thread, which must not be the loop
+        return await asyncio.to_thread(
+            render_engine.run, fn, *args, timeout=RENDER_TIMEOUT
+        )
+
+    future = render_engine.submit(fn, *args)
+    try:
+        await asyncio.wait_for(asyncio.wrap_future(future), RENDER_TIMEOUT)
+    except TimeoutError:
+        msg = f"Rendering timed out after {RENDER_TIMEOUT} seconds."
+        raise TimeoutError(msg) from None
+    return render_engine.result(future)
+
+
+async def generate(board, response_mode, persist, profile, map_colors):
+    # renderer.generate_board's steps, with file and network access on threads and
+    # rendering on the engine
+    steps = generate_steps(
+        board, persist, response_mode in ("png", "base64"), profile, map_colors
+    )
+    result = None
+    try:
+        while True:
+            kind, fn, args = steps.send(result)
+            if kind == "render":
+                result = await render(fn, *args)
+            else:
+                result = await asyncio.to_thread(fn, *args)
+    except StopIteration as e:
+        return e.value
+
+
+async def generate_image(scope, receive, send):
+    try:
+        with metrics.stage("read_body"):
+            body = await read_body(receive)
+        try:
+            with metrics.stage("parse_json"):
+                data = json.loads(body)
+        except ValueError as e:
+            msg = f"Invalid JSON body: {e}"
+            raise ValueError(msg) from None
+
+        response_mode, persist, profile, map_colors = parse_output_options(
+            query_args(scope)
+        )
+        board = parse_board(data)
+        result = await generate(board, response_mode, persist, profile, map_colors)
+
+    except ConnectionResetError:
+        return
+    except HTTPError as e:
+        metrics.record_error(e)
+        await send_json(send, e.status, {"imggen": str(e)})
+        return
+    except QueueFullError as e:
+        metrics.record_error(e)
+        await send_json(send, 429, {"imggen": str(e)}, {"Retry-After": "1"})
+        return
+    except Exception as e:
+        metrics.record_error(e)
+        await send_json(send, 500, {"imggen": str(e)})
+        return
+
+    # Return URL, or the encoded image itself
+    status, body, content_type, headers = response_parts(result, response_mode)
+    if content_type == "application/json":
+        await send_json(send, status, body)
+        return
+    await send_response(send, status, body, content_type, headers)
+
+
+async def evaluate_board(scope, receive, send):
+    try:
+        with metrics.stage("read_body"):
+            body = await read_body(receive)
+        try:
+            with metrics.stage("parse_json"):
+                data = json.loads(body)
+        except ValueError as e:
+            msg = f"Invalid JSON body: {e}"
+            raise ValueError(msg) from None
+
+        # Cheap enough to score on the loop itself
+        board = parse_board(data)
+        result = score_board(board)
+
+    except ConnectionResetError:
+        return
+    except HTTPError as e:
+        metrics.record_error(e)
+        await send_json(send, e.status, {"imggen": str(e)})
+        return
+    except Exception as e:
+        metrics.record_error(e)
+        await send_json(send, 500, {"imggen": str(e)})
+        return
+
+    await send_json(send, 200, result)
+
+
+async def stats(scope, receive, send):
+    body = cache_stats()
+    body["render_engine"] = render_engine.stats()
+    body["render_workers"] = dict(render_engine.worker_stats)
+    await send_json(send, 200, body)
+
+
+async def prometheus_metrics(scope, receive, send):
+    body = metrics.render_metrics().encode()
+    await send_response(send, 200, body, "text/plain; version=0.0.4")
+
+
+ROUTES = {
+    "/generate": ("POST", generate_image),
+    "/evaluate": ("POST", evaluate_board),
+    "/stats": ("GET", stats),
+    "/metrics": ("GET", prometheus_metrics),
+}
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await asyncio.to_thread(render_engine.start)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await asyncio.to_thread(render_engine.shutdown)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    route = ROUTES.get(scope["path"])
+    # A client that disconnects never gets a status; count it the way nginx logs it
+    status = 499
+
+    async def send_with_status(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        await send(message)
+
+    metrics.start_request()
+    if route is not None and scope["path"] in PROFILED_ROUTES:
+        profiler.start_request(sample_thread=False)
+    try:
+        if route is None:
+            await send_json(send_with_status, 404, {"imggen": "Not found."})
+            return
+
+        method, handler = route
+        if scope["method"] != method:
+            await send_json(
+                send_with_status,
+                405,
+                {"imggen": "Method not allowed."},
+                {"Allow": method},
+            )
+            return
+
+        await handler(scope, receive, send_with_status)
+    finally:
+        profiler.finish_request()
+        metrics.finish_request(scope["path"] if route else "unmatched", status)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "asgi:app",
+        host="0.0.0.0",
+        port=int(os.environ.get("IMGGEN_PORT", 5000)),
+        workers=env_int("IMGGEN_WORKERS", 1) or 1,
+    )
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+
+from PIL import Image
+
+# Header: magic, version, then the length of the RGBA pixel data that follows
+HEADER = struct.Struct("<8sBQ")
+MAGIC = b"IMGGENTA"
+VERSION = 3
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "atlas.bin")
+
+
+def index_path(path: str) -> str:
+    return os.path.splitext(path)[0] + ".json"
+
+
+def texture_files(root: str):
+    # (name, path) of every PNG under root, names relative to it as requests use them
+    for directory, _, filenames in os.walk(root):
+        for filename in sorted(filenames):
+            if not filename.lower().endswith(".png"):
+                continue
+            path = os.path.join(directory, filename)
+            name = os.path.normpath(os.path.relpath(path, root)).replace(os.sep, "/")
+            yield name, path
+
+
+def fingerprint(root: str) -> str:
+    # Texture names and the mtime of every directory holding them, so startup costs a
+    # listing rather than a stat per file. Adding, removing or renaming a texture changes
+    # it; a file rewritten in place does not, which is why the image always builds its
+    # atlas after copying the textures
+    digest = hashlib.sha256()
+    for directory, subdirectories, filenames in os.walk(root):
+        subdirectories.sort()
+        names = "\0".join(
+            sorted(name for name in filenames if name.lower().endswith(".png"))
+        )
+        relative = os.path.relpath(directory, root)
+        digest.update(
+            f"{relative}\0{os.stat(directory).st_mtime_ns}\0{names}\n".encode()
+        )
+    return digest.hexdigest()
+
+
+def add_texture(digest, name: str, width: int, height: int, data: bytes) -> None:
+    # One texture's part of the content hash; the atlas and loose files agree on it
+    digest.update(f"{name}\0{width}\0{height}\0".encode())
+    digest.update(data)
+
+
+def open_atlas(path: str, root: str):
+    # Returns (mapped, sprites, content) with sprites as {name: (offset, width, height)}
+    # and content the hash of every texture's pixels, or None when the atlas is missing,
+    # stale or was built from another directory
+    try:
+        with open(index_path(path)) as index_file:
+            index = json.load(index_file)
+        with open(path, "rb") as atlas_file:
+            mapped = mmap.mmap(atlas_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    magic, version, length = HEADER.unpack_from(mapped)
+    if (
+        magic != MAGIC
+        or version != VERSION
+        or len(mapped) != HEADER.size + length
+        or index.get("version") != VERSION
+        or index.get("root") != os.path.realpath(root)
+        or index.get("fingerprint") != fingerprint(root)
+    ):
+        mapped.close()
+        return None
+
+    sprites = {name: tuple(entry) for name, entry in index["sprites"].items()}
+    return mapped, sprites, index["content"]
+
+
+def build(root: str, path: str) -> None:
+    sprites = {}
+    textures = fingerprint(root)
+    content = hashlib.sha256()
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as atlas_file:
+        atlas_file.write(HEADER.pack(MAGIC, VERSION, 0))
+        offset = HEADER.size
+        for name, texture_path in texture_files(root):
+            with Image.open(texture_path) as texture_image:
+                data = texture_image.convert("RGBA").tobytes()
+                width, height = texture_image.size
+            atlas_file.write(data)
+            add_texture(content, name, width, height, data)
+            sprites[name] = (offset, width, height)
+            offset += len(data)
+
+        atlas_file.seek(0)
+        atlas_file.write(HEADER.pack(MAGIC, VERSION, offset - HEADER.size))
+
+    index = {
+        "version": VERSION,
+        "root": os.path.realpath(root),
+        "fingerprint": textures,
+        "content": content.hexdigest(),
+        "sprites": sprites,
+    }
+    temp_index_path = f"{index_path(path)}.tmp"
+    with open(temp_index_path, "w") as index_file:
+        json.dump(index, index_file, separators=(",", ":"))
+
+    # Pixels first, then the index that points into them
+    os.replace(temp_path, path)
+    os.replace(temp_index_path, index_path(path))
+
+
+if __name__ == "__main__":
+    build(
+        sys.argv[1] if len(sys.argv) > 1 else "/app/textures",
+        sys.argv[2] if len(sys.argv) > 2 else DEFAULT_PATH,
+    )
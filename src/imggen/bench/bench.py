@@ -0,0 +1,309 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+IMGGEN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(IMGGEN_DIR, "bench", "baseline.json")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the imggen rendering pipeline (offline, no server)."
+    )
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--completion-ratio", type=float, default=0.3)
+    parser.add_argument("--textures-dir", default=os.path.join(IMGGEN_DIR, "textures"))
+    parser.add_argument(
+        "--only", nargs="*", default=None, help="Benchmark names to run"
+    )
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="Store this run as the baseline"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Allowed p50 slowdown against the baseline (0.2 = 20%%)",
+    )
+    parser.add_argument(
+        "--p99-threshold",
+        type=float,
+        default=0.5,
+        help="Allowed p99 slowdown against the baseline",
+    )
+    parser.add_argument(
+        "--min-delta-ms",
+        type=float,
+        default=0.05,
+        help="Ignore slowdowns smaller than this, in milliseconds",
+    )
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    return parser.parse_args()
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(samples):
+    mean = statistics.fmean(samples)
+    return {
+        "samples": len(samples),
+        "p50_ms": round(percentile(samples, 0.50) * 1000, 4),
+        "p99_ms": round(percentile(samples, 0.99) * 1000, 4),
+        "mean_ms": round(mean * 1000, 4),
+        "per_second": round(1 / mean, 1) if mean else None,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - started
+
+
+def run_benchmarks(args):
+    import grid_layout
+    import renderer
+    from encoding import PROFILES
+    from payloads import board_matrix, list_sprites
+    from texture_store import TextureStore
+
+    sprites = list_sprites(args.textures_dir)
+    boards = list(board_matrix(args.seed, sprites, args.completion_ratio))
+    parsed = [(name, renderer.parse_board(board)) for name, board in boards]
+    for _, board in parsed:
+        renderer.validate_items(board)
+
+    def by_grid_size(name):
+        return name.split("-")[0]
+
+    def texture_load():
+        samples = []
+        for _ in range(max(3, args.iterations // 2)):
+            store = TextureStore(args.textures_dir)
+            samples.append(timed(store.load))
+        return {"texture_load": samples}
+
+    def grid_params_solve():
+        samples = []
+        constraint_sets = [
+            dict(grid_layout.DEFAULT_CONSTRAINTS[grid_size], max_padding=16)
+            for grid_size in range(1, 10)
+        ] + [
+            {"min_padding": 1, "pixel_perfect": True, "fill_board": False},
+            {"min_border_width": 2, "max_line_width": 8, "fill_board": False},
+        ]
+        for _ in range(args.iterations):
+            for grid_size in range(1, 10):
+                for constraints in constraint_sets:
+                    grid_layout.solve_grid_params.cache_clear()
+                    try:
+                        samples.append(
+                            timed(
+                                grid_layout.compute_grid_params, grid_size, constraints
+                            )
+                        )
+                    except ValueError:
+                        pass
+        return {"grid_params_solve": samples}
+
+    def grid_params_lookup():
+        samples = []
+        for _ in range(args.iterations):
+            for grid_size in range(1, 10):
+                samples.append(timed(grid_layout.default_grid_params, grid_size))
+        return {"grid_params_lookup": samples}
+
+    def detect_bingo():
+        groups = {}
+        for _ in range(args.iterations):
+            for name, board in parsed:
+                elapsed = timed(
+                    renderer.detect_bingo,
+                    board["grid_size"],
+                    board["items"],
+                    None,
+                    board["grid_params"],
+                    board["team_info"],
+                )
+                groups.setdefault(f"detect_bingo[{by_grid_size(name)}]", []).append(
+                    elapsed
+                )
+        return groups
+
+    encoded_sizes = {}
+
+    def encode():
+        images = [renderer.render_board(board)[0] for _, board in parsed]
+        groups = {}
+        for profile in PROFILES:
+            group = f"encode[{profile}]"
+            sizes = encoded_sizes.setdefault(group, [])
+            for _ in range(args.iterations):
+                for image in images:
+                    started = time.perf_counter()
+                    data = renderer.encode_image(image, profile)
+                    groups.setdefault(group, []).append(time.perf_counter() - started)
+                    sizes.append(len(data))
+        return groups
+
+    def render(cold):
+        label = "render_cold" if cold else "render_warm"
+        groups = {}
+
+        def render_and_encode(board):
+            image, _ = renderer.render_board(board)
+            renderer.encode_image(image)
+
+        if not cold:
+            # One untimed pass to fill the caches
+            for _, board in parsed:
+                renderer.render_board(board)
+
+        for _ in range(args.iterations):
+            for name, board in parsed:
+                if cold:
+                    renderer.clear_caches()
+                elapsed = timed(render_and_encode, board)
+                groups.setdefault(label, []).append(elapsed)
+                groups.setdefault(f"{label}[{by_grid_size(name)}]", []).append(elapsed)
+        return groups
+
+    benchmarks = {
+        "texture_load": texture_load,
+        "grid_params_solve": grid_params_solve,
+        "grid_params_lookup": grid_params_lookup,
+        "detect_bingo": detect_bingo,
+        "encode": encode,
+        "render_cold": lambda: render(cold=True),
+        "render_warm": lambda: render(cold=False),
+    }
+
+    results = {}
+    for name, benchmark in benchmarks.items():
+        if args.only and name not in args.only:
+            continue
+        for group, samples in benchmark().items():
+            results[group] = summarize(samples)
+            if group in encoded_sizes:
+                results[group]["mean_bytes"] = round(
+                    statistics.fmean(encoded_sizes[group])
+                )
+    return results
+
+
+def compare(results, baseline, threshold, p99_threshold, min_delta_ms):
+    regressions = []
+    rows = []
+    for name, current in results.items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            rows.append((name, current, None, None))
+            continue
+        p50_change = (
+            current["p50_ms"] / previous["p50_ms"] - 1 if previous["p50_ms"] else 0
+        )
+        p99_change = (
+            current["p99_ms"] / previous["p99_ms"] - 1 if previous["p99_ms"] else 0
+        )
+        rows.append((name, current, p50_change, p99_change))
+
+        p50_regressed = (
+            p50_change > threshold
+            and current["p50_ms"] - previous["p50_ms"] > min_delta_ms
+        )
+        # p99 of a small sample is just its slowest run, so only judge it on enough data
+        p99_regressed = (
+            current["samples"] >= 100
+            and p99_change > p99_threshold
+            and current["p99_ms"] - previous["p99_ms"] > min_delta_ms
+        )
+        if p50_regressed or p99_regressed:
+            regressions.append(name)
+    return rows, regressions
+
+
+def print_table(rows):
+    header = f"{'benchmark':<28} {'p50 ms':>10} {'p99 ms':>10} {'per sec':>10} {'rss MB':>8} {'p50 Δ':>8} {'p99 Δ':>8} {'bytes':>8}"
+    print(header)
+    print("-" * len(header))
+    for name, current, p50_change, p99_change in rows:
+        p50_delta = f"{p50_change:+.0%}" if p50_change is not None else "-"
+        p99_delta = f"{p99_change:+.0%}" if p99_change is not None else "-"
+        size = current.get("mean_bytes", "-")
+        print(
+            f"{name:<28} {current['p50_ms']:>10.3f} {current['p99_ms']:>10.3f} "
+            f"{current['per_second'] or 0:>10.1f} {current['peak_rss_mb']:>8.1f} "
+            f"{p50_delta:>8} {p99_delta:>8} {size:>8}"
+        )
+
+
+def main():
+    args = parse_args()
+
+    # Point the renderer at the local textures and a throwaway output dir before import
+    os.environ.setdefault("IMGGEN_TEXTURES_DIR", args.textures_dir)
+    os.environ.setdefault("IMGGEN_OUTPUT_DIR", tempfile.mkdtemp(prefix="imggen-bench-"))
+    sys.path.insert(0, IMGGEN_DIR)
+
+    results = run_benchmarks(args)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    rows, regressions = compare(
+        results, baseline, args.threshold, args.p99_threshold, args.min_delta_ms
+    )
+
+    if args.json:
+        print(json.dumps({"results": results, "regressions": regressions}, indent=2))
+    else:
+        print_table(rows)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(
+                {
+                    "meta": {
+                        "seed": args.seed,
+                        "iterations": args.iterations,
+                        "python": platform.python_version(),
+                        "machine": platform.machine(),
+                    },
+                    "results": results,
+                },
+                baseline_file,
+                indent=2,
+                sort_keys=True,
+            )
+        print(f"Baseline written to {args.baseline}", file=sys.stderr)
+
+    if regressions:
+        print(f"Regressions: {', '.join(regressions)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
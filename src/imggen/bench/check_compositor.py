@@ -0,0 +1,247 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+IMGGEN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Random alpha in every pixel, so partial blending is covered and not just 0 and 255
+TRANSLUCENT_SPRITE = "sprites/check-compositor-translucent.png"
+PLACEMENTS = [
+    "top",
+    "bottom",
+    "left",
+    "right",
+    "full",
+    "top-left",
+    "top-right",
+    "bottom-left",
+    "bottom-right",
+    "middle",
+    ["not", "a", "placement"],
+]
+COLORS = ["#FF6464", "#64FFFF", "#12345678", "#0f0", "red", "#FFFFFF00"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Check the numpy compositor against the reference Pillow drawing path on "
+            "seeded random boards."
+        )
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--boards", type=int, default=300)
+    parser.add_argument("--textures-dir", default=os.path.join(IMGGEN_DIR, "textures"))
+    return parser.parse_args()
+
+
+def mark_rect(draw, x0, y0, x1, y1, color):
+    # Inclusive corners, drawn as a filled polygon like the original marks
+    draw.polygon([(x0, y0), (x1, y0), (x1, y1), (x0, y1)], fill=color)
+
+
+def draw_corner(draw, corner, x, y, cell_width, padding, color):
+    half = cell_width // 2
+    right = x + cell_width - 1
+    bottom = y + cell_width - 1
+    match corner:
+        case "top-left":
+            mark_rect(draw, x, y, x + half - 1, y + padding - 1, color)
+            mark_rect(draw, x, y, x + padding - 1, y + half - 1, color)
+        case "top-right":
+            mark_rect(draw, x + half, y, right, y + padding - 1, color)
+            mark_rect(draw, right - padding + 1, y, right, y + half - 1, color)
+        case "bottom-left":
+            mark_rect(draw, x, bottom - padding + 1, x + half - 1, bottom, color)
+            mark_rect(draw, x, y + half, x + padding - 1, bottom, color)
+        case "bottom-right":
+            mark_rect(draw, x + half, bottom - padding + 1, right, bottom, color)
+            mark_rect(draw, right - padding + 1, y + half, right, bottom, color)
+
+
+def reference_render(board):
+    # The board drawn with Image.new, ImageDraw and alpha pastes, as before the compositor
+    from grid_layout import IMG_SIZE
+    from renderer import (
+        board_items,
+        board_width,
+        cell_position,
+        completed_teams_of,
+        detect_bingo,
+        texture_store,
+    )
+
+    grid_size = board["grid_size"]
+    grid_params = board["grid_params"]
+    cell_width = grid_params["cell_width"]
+    line_width = grid_params["line_width"]
+    border_width = grid_params["border_width"]
+    padding = grid_params["padding"]
+    asset_width = grid_params["asset_width"]
+    used_width = board_width(grid_size, grid_params)
+
+    image = Image.new("RGBA", (IMG_SIZE, IMG_SIZE), board["bg_color"])
+    draw = ImageDraw.Draw(image)
+
+    if line_width > 0:
+        for i in range(grid_size - 1):
+            offset = border_width + (i + 1) * cell_width + i * line_width
+            end = offset + line_width - 1
+            mark_rect(draw, offset, 0, end, used_width - 1, board["line_color"])
+            mark_rect(draw, 0, offset, used_width - 1, end, board["line_color"])
+
+    if border_width > 0:
+        draw.rectangle(
+            (0, 0, used_width - 1, used_width - 1),
+            outline=board["border_color"],
+            width=border_width,
+        )
+
+    for item in board_items(board):
+        texture = texture_store.get(item["sprite"]).resize(
+            (asset_width, asset_width), resample=Image.Resampling.NEAREST
+        )
+        x, y = cell_position(grid_params, item["row"], item["column"])
+        image.paste(texture, (x + padding, y + padding), texture)
+
+    if padding > 0:
+        for item in board_items(board):
+            x, y = cell_position(grid_params, item["row"], item["column"])
+            for team in completed_teams_of(item):
+                color = board["team_info"][team]["color"]
+                placement = board["team_info"][team]["placement"]
+                match placement:
+                    case "top":
+                        corners = ["top-left", "top-right"]
+                    case "bottom":
+                        corners = ["bottom-left", "bottom-right"]
+                    case "left":
+                        corners = ["top-left", "bottom-left"]
+                    case "right":
+                        corners = ["top-right", "bottom-right"]
+                    case "full":
+                        draw.rectangle(
+                            (x, y, x + cell_width - 1, y + cell_width - 1),
+                            outline=color,
+                            width=padding,
+                        )
+                        corners = []
+                    case _:
+                        corners = [placement]
+                for corner in corners:
+                    draw_corner(draw, corner, x, y, cell_width, padding, color)
+
+    report = detect_bingo(
+        grid_size, board["items"], draw, grid_params, board["team_info"]
+    )
+
+    if board["center_board"] and used_width != IMG_SIZE:
+        offset = (IMG_SIZE - used_width) // 2
+        board_image = image.crop((0, 0, used_width, used_width))
+        image = Image.new("RGBA", (IMG_SIZE, IMG_SIZE), board["outer_bg_color"])
+        image.paste(board_image, (offset, offset))
+
+    return image, report
+
+
+def random_board(rng, sprites):
+    grid_size = rng.randint(1, 9)
+    teams = [
+        {
+            "name": f"team{index + 1}",
+            "placement": rng.choice(PLACEMENTS),
+            "color": rng.choice(COLORS),
+        }
+        for index in range(rng.randint(0, 4))
+    ]
+
+    # Out of range and repeated cells included; repeats stack their sprites and marks
+    items = []
+    for _ in range(rng.randint(0, grid_size * grid_size * 2)):
+        items.append(
+            {
+                "row": rng.randrange(grid_size + 1),
+                "column": rng.randrange(grid_size + 1),
+                "sprite": rng.choice(sprites),
+                "completed": {
+                    team["name"]: rng.random() < 0.6
+                    for team in rng.sample(teams, len(teams))
+                },
+            }
+        )
+    if teams and rng.random() < 0.4:
+        # A diagonal, so bingo lines are drawn too
+        winner = rng.choice(teams)["name"]
+        items += [
+            {
+                "row": index,
+                "column": index,
+                "sprite": rng.choice(sprites),
+                "completed": {winner: True},
+            }
+            for index in range(grid_size)
+        ]
+
+    settings = {
+        "grid_size": grid_size,
+        "teams": teams,
+        "colors": {
+            "bg_color": rng.choice(["#D6BE96", "#20304080"]),
+            "outer_bg_color": "#010203",
+        },
+    }
+    if rng.random() < 0.5:
+        settings["constraints"] = {
+            "min_padding": rng.randint(0, 4),
+            "fill_board": rng.random() < 0.5,
+            "pixel_perfect": rng.random() < 0.5,
+            "center_board": rng.random() < 0.5,
+        }
+    return {"settings": settings, "items": items}
+
+
+def main():
+    args = parse_args()
+
+    os.environ.setdefault("IMGGEN_TEXTURES_DIR", args.textures_dir)
+    os.environ.setdefault("IMGGEN_OUTPUT_DIR", tempfile.mkdtemp(prefix="imggen-check-"))
+    sys.path.insert(0, IMGGEN_DIR)
+    from renderer import parse_board, render_board, texture_store
+
+    pixels = np.random.RandomState(args.seed).randint(0, 256, (16, 16, 4))
+    texture_store.textures[TRANSLUCENT_SPRITE] = Image.fromarray(
+        pixels.astype(np.uint8)
+    )
+    sprites = sorted(texture_store.textures)
+
+    rng = random.Random(args.seed)
+    mismatches = 0
+    for _ in range(args.boards):
+        data = random_board(rng, sprites)
+        board = parse_board(data)
+        image, report = render_board(board)
+        expected_image, expected_report = reference_render(parse_board(data))
+
+        actual = np.asarray(image)
+        expected = np.asarray(expected_image)
+        if not np.array_equal(actual, expected) or report != expected_report:
+            mismatches += 1
+            differing = int((actual != expected).any(axis=2).sum())
+            print(
+                f"MISMATCH grid_size={board['grid_size']} "
+                f"grid_params={board['grid_params']}: {differing} pixels differ, "
+                f"winner {report['winner']} (expected {expected_report['winner']})"
+            )
+
+    print(f"{args.boards} boards, {mismatches} mismatches")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+import argparse
+import os
+import random
+import sys
+
+IMGGEN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Check the grid layout solver and the prebuilt layout table against an "
+            "exhaustive scan on seeded random constraints."
+        )
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--cases", type=int, default=300, help="Constraints with max_* widths (solver)"
+    )
+    parser.add_argument(
+        "--table-cases",
+        type=int,
+        default=40,
+        help="Constraints with only min_* widths (layout table)",
+    )
+    return parser.parse_args()
+
+
+def brute_force(
+    grid_size,
+    min_padding,
+    max_padding,
+    min_line_width,
+    max_line_width,
+    min_border_width,
+    max_border_width,
+    pixel_perfect,
+    fill_board,
+):
+    # Every border, line, cell and padding width in ascending order, as the layout was
+    # searched before the solver; the first layout with the best score wins
+    from grid_layout import IMG_SIZE, is_pixel_perfect
+
+    best = None
+    best_score = None
+    for border_width in range(min_border_width, max_border_width + 1):
+        for line_width in range(min_line_width, max_line_width + 1):
+            remaining = IMG_SIZE - line_width * (grid_size - 1) - border_width * 2
+            if remaining <= 0:
+                continue
+
+            if fill_board:
+                if remaining % grid_size != 0:
+                    continue
+                cell_widths = [remaining // grid_size]
+            else:
+                cell_widths = range(1, remaining // grid_size + 1)
+
+            for cell_width in cell_widths:
+                max_cell_padding = min(max_padding, cell_width // 2)
+                for padding in range(min_padding, max_cell_padding + 1):
+                    asset_width = cell_width - padding * 2
+                    if asset_width <= 0:
+                        continue
+                    if pixel_perfect and not is_pixel_perfect(asset_width):
+                        continue
+
+                    score = (
+                        asset_width * 1000
+                        - (padding - min_padding) * 20
+                        - (line_width - min_line_width) * 10
+                        - (border_width - min_border_width) * 10
+                    )
+                    if best is None or score > best_score:
+                        best_score = score
+                        best = {
+                            "cell_width": cell_width,
+                            "asset_width": asset_width,
+                            "padding": padding,
+                            "line_width": line_width,
+                            "border_width": border_width,
+                        }
+    return best
+
+
+def random_constraints(rng, bounded):
+    # bounded sets max_* widths, so the solver runs; otherwise only min_* widths within
+    # the range the layout table covers
+    constraints = {}
+    for key, limit in (("padding", 12), ("line_width", 20), ("border_width", 20)):
+        if rng.random() < 0.8:
+            constraints[f"min_{key}"] = rng.randint(0, limit // 2)
+        if bounded and rng.random() < 0.9:
+            constraints[f"max_{key}"] = constraints.get(f"min_{key}", 0) + rng.randint(
+                0, limit
+            )
+    if rng.random() < 0.7:
+        constraints["pixel_perfect"] = rng.random() < 0.5
+    if rng.random() < 0.7:
+        constraints["fill_board"] = rng.random() < 0.5
+    return constraints
+
+
+def expected_layout(grid_size, constraints):
+    from grid_layout import IMG_SIZE
+
+    def get(key, default):
+        value = constraints.get(key)
+        return default if value is None else value
+
+    return brute_force(
+        grid_size,
+        get("min_padding", 0),
+        get("max_padding", IMG_SIZE // 2),
+        get("min_line_width", 0),
+        get("max_line_width", IMG_SIZE),
+        get("min_border_width", 0),
+        get("max_border_width", IMG_SIZE),
+        get("pixel_perfect", True),
+        get("fill_board", True),
+    )
+
+
+def actual_layout(grid_size, constraints):
+    from grid_layout import compute_grid_params
+
+    try:
+        return compute_grid_params(grid_size, dict(constraints))
+    except ValueError:
+        return None
+
+
+def check(rng, cases, bounded):
+    mismatches = 0
+    checked = 0
+    while checked < cases:
+        grid_size = rng.randint(1, 9)
+        constraints = random_constraints(rng, bounded)
+        unbounded = "max_line_width" not in constraints or (
+            "max_border_width" not in constraints
+        )
+        if grid_size == 1 and unbounded and not constraints.get("fill_board", True):
+            # Unbounded widths on a 1x1 board without fill_board take seconds to scan
+            continue
+        checked += 1
+
+        expected = expected_layout(grid_size, constraints)
+        actual = actual_layout(grid_size, constraints)
+        if actual != expected:
+            mismatches += 1
+            print(
+                f"MISMATCH grid_size={grid_size} constraints={constraints}\n"
+                f"  expected {expected}\n  got      {actual}"
+            )
+    return mismatches
+
+
+def main():
+    args = parse_args()
+    sys.path.insert(0, IMGGEN_DIR)
+    from grid_layout import layout_table
+
+    rng = random.Random(args.seed)
+    solver_mismatches = check(rng, args.cases, bounded=True)
+    table_mismatches = check(rng, args.table_cases, bounded=False)
+
+    table = layout_table.stats()
+    print(
+        f"solver: {args.cases} cases, {solver_mismatches} mismatches; "
+        f"table: {args.table_cases} cases, {table_mismatches} mismatches "
+        f"({table['hits']} table hits, loaded={table['loaded']})"
+    )
+    if solver_mismatches or table_mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,381 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from payloads import TEAM_PLACEMENTS
+
+IMGGEN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.join(IMGGEN_DIR, "bench")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Load test imggen end to end: lobbies create and update boards through a "
+            "mapgen stand-in, then download each image from a static /public server."
+        )
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4],
+        help="gunicorn worker counts to sweep",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        nargs="+",
+        default=[1, 4, 16, 32],
+        help="Concurrent lobbies per step",
+    )
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per step")
+    parser.add_argument("--grid-size", type=int, default=5)
+    parser.add_argument("--teams", type=int, default=2, choices=sorted(TEAM_PLACEMENTS))
+    parser.add_argument(
+        "--updates-per-lobby",
+        type=int,
+        default=30,
+        help="Updates before a lobby ends and a new one is created",
+    )
+    parser.add_argument("--threads", type=int, default=1, help="IMGGEN_THREADS")
+    parser.add_argument(
+        "--render-processes", type=int, default=0, help="IMGGEN_RENDER_PROCESSES"
+    )
+    parser.add_argument(
+        "--no-fetch", action="store_true", help="Skip downloading the images"
+    )
+    parser.add_argument(
+        "--imggen-url",
+        default=None,
+        help="Test an already running imggen instead of starting gunicorn",
+    )
+    parser.add_argument("--textures-dir", default=os.path.join(IMGGEN_DIR, "textures"))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    return parser.parse_args()
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def wait_ready(port, path, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", path)
+            connection.getresponse().read()
+            connection.close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    msg = f"Nothing answered on port {port} within {timeout} seconds."
+    raise TimeoutError(msg)
+
+
+def start_process(command, env=None, cwd=None):
+    return subprocess.Popen(
+        command,
+        cwd=cwd,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def stop_process(process):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def start_imggen(args, workers, output_dir):
+    port = free_port()
+    env = dict(
+        os.environ,
+        IMGGEN_PORT=str(port),
+        IMGGEN_WORKERS=str(workers),
+        IMGGEN_THREADS=str(args.threads),
+        IMGGEN_RENDER_PROCESSES=str(args.render_processes),
+        IMGGEN_OUTPUT_DIR=output_dir,
+        IMGGEN_TEXTURES_DIR=args.textures_dir,
+        IMGGEN_METRICS_DIR=tempfile.mkdtemp(prefix="imggen-load-metrics-"),
+        IMGGEN_SESSION_DIR=tempfile.mkdtemp(prefix="imggen-load-sessions-"),
+    )
+    command = [
+        sys.executable,
+        "-m",
+        "gunicorn",
+        "--config",
+        "gunicorn.conf.py",
+        "generator:app",
+    ]
+    process = start_process(command, env, IMGGEN_DIR)
+    wait_ready(port, "/stats")
+    return process, f"http://127.0.0.1:{port}"
+
+
+class Client:
+    # One lobby at a time: create a board, then complete one more cell per update
+    def __init__(self, mapgen_port, static_port, args, rng):
+        self.mapgen = http.client.HTTPConnection("127.0.0.1", mapgen_port, timeout=120)
+        self.static = http.client.HTTPConnection("127.0.0.1", static_port, timeout=30)
+        self.args = args
+        self.rng = rng
+        self.teams = [
+            {"name": f"team{i + 1}", "placement": placement}
+            for i, placement in enumerate(TEAM_PLACEMENTS[args.teams])
+        ]
+        self.map_raw = None
+        self.updates = 0
+
+    def post(self, path, body):
+        try:
+            self.mapgen.request(
+                "POST", path, json.dumps(body), {"Content-Type": "application/json"}
+            )
+            response = self.mapgen.getresponse()
+            return response.status, json.loads(response.read())
+        except (OSError, http.client.HTTPException, ValueError):
+            self.mapgen.close()
+            return None, None
+
+    def fetch(self, map_url):
+        try:
+            self.static.request("GET", map_url)
+            response = self.static.getresponse()
+            response.read()
+            return response.status
+        except (OSError, http.client.HTTPException):
+            self.static.close()
+            return None
+
+    def complete_cell(self):
+        # Lobbies fill up over time: a team completes one of its open cells
+        if not self.teams:
+            return
+        team = self.rng.choice(self.teams)["name"]
+        open_items = [
+            item for item in self.map_raw["items"] if not item["completed"].get(team)
+        ]
+        if open_items:
+            self.rng.choice(open_items)["completed"][team] = True
+
+    def step(self):
+        # Returns (kind, seconds, status, fetch_seconds, fetch_status)
+        if self.map_raw is None or self.updates >= self.args.updates_per_lobby:
+            kind = "create"
+            settings = {"grid_size": self.args.grid_size, "teams": self.teams}
+            started = time.perf_counter()
+            status, body = self.post("/Map/create", {"settings": settings})
+            elapsed = time.perf_counter() - started
+            if status == 200:
+                self.map_raw = body["map_raw"]
+                self.updates = 0
+        else:
+            kind = "update"
+            self.complete_cell()
+            started = time.perf_counter()
+            status, body = self.post("/Map/update", {"map_raw": self.map_raw})
+            elapsed = time.perf_counter() - started
+            self.updates += 1
+
+        fetch_elapsed = fetch_status = None
+        if status == 200 and not self.args.no_fetch:
+            started = time.perf_counter()
+            fetch_status = self.fetch(body["map_url"])
+            fetch_elapsed = time.perf_counter() - started
+        return kind, elapsed, status, fetch_elapsed, fetch_status
+
+
+def run_step(mapgen_port, static_port, args, concurrency):
+    samples = []
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def lobby(index):
+        client = Client(
+            mapgen_port, static_port, args, random.Random(args.seed * 1000 + index)
+        )
+        local = []
+        while not stop.is_set():
+            local.append(client.step())
+        with lock:
+            samples.extend(local)
+
+    threads = [
+        threading.Thread(target=lobby, args=(index,), daemon=True)
+        for index in range(concurrency)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - started
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def milliseconds(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def summarize(samples, elapsed):
+    latencies = [sample[1] for sample in samples if sample[2] == 200]
+    fetches = [sample[3] for sample in samples if sample[4] == 200]
+    errors = sum(1 for sample in samples if sample[2] != 200)
+    fetch_errors = sum(
+        1 for sample in samples if sample[3] is not None and sample[4] != 200
+    )
+    return {
+        "requests": len(samples),
+        "creates": sum(1 for sample in samples if sample[0] == "create"),
+        "throughput": round(len(latencies) / elapsed, 1),
+        "p50_ms": milliseconds(percentile(latencies, 0.5)),
+        "p95_ms": milliseconds(percentile(latencies, 0.95)),
+        "p99_ms": milliseconds(percentile(latencies, 0.99)),
+        "max_ms": milliseconds(max(latencies) if latencies else None),
+        "fetch_p99_ms": milliseconds(percentile(fetches, 0.99)),
+        "error_rate": round(errors / len(samples), 4) if samples else 0.0,
+        "fetch_error_rate": (round(fetch_errors / len(samples), 4) if samples else 0.0),
+    }
+
+
+def print_table(results):
+    header = (
+        f"{'workers':>7} {'lobbies':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+        f"{'p99 ms':>8} {'max ms':>8} {'fetch p99':>9} {'errors':>7}"
+    )
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        print(
+            f"{result['workers']:>7} {result['concurrency']:>7} "
+            f"{result['throughput']:>8.1f} {result['p50_ms'] or 0:>8.1f} "
+            f"{result['p95_ms'] or 0:>8.1f} {result['p99_ms'] or 0:>8.1f} "
+            f"{result['max_ms'] or 0:>8.1f} {result['fetch_p99_ms'] or 0:>9.1f} "
+            f"{result['error_rate']:>7.2%}"
+        )
+
+    print()
+    for workers, best in saturation(results).items():
+        print(
+            f"{workers} worker(s): saturates at {best['throughput']:.1f} req/s "
+            f"with {best['concurrency']} lobbies (p99 {best['p99_ms']} ms)"
+        )
+
+
+def saturation(results):
+    # Highest throughput per worker count; more lobbies past it only add latency
+    best = {}
+    for result in results:
+        current = best.get(result["workers"])
+        if current is None or result["throughput"] > current["throughput"]:
+            best[result["workers"]] = result
+    return best
+
+
+def main():
+    args = parse_args()
+    output_dir = tempfile.mkdtemp(prefix="imggen-load-public-")
+    processes = []
+    results = []
+
+    try:
+        worker_counts = [None] if args.imggen_url else args.workers
+        for workers in worker_counts:
+            imggen_url = args.imggen_url
+            imggen = None
+            if imggen_url is None:
+                imggen, imggen_url = start_imggen(args, workers, output_dir)
+
+            mapgen_port = free_port()
+            static_port = free_port()
+            stand_ins = [
+                start_process(
+                    [
+                        sys.executable,
+                        os.path.join(BENCH_DIR, "standins.py"),
+                        "mapgen",
+                        "--port",
+                        str(mapgen_port),
+                        "--imggen-url",
+                        imggen_url,
+                        "--textures-dir",
+                        args.textures_dir,
+                    ]
+                ),
+                start_process(
+                    [
+                        sys.executable,
+                        os.path.join(BENCH_DIR, "standins.py"),
+                        "static",
+                        "--port",
+                        str(static_port),
+                        "--directory",
+                        output_dir,
+                    ]
+                ),
+            ]
+            processes = stand_ins + ([imggen] if imggen else [])
+            wait_ready(mapgen_port, "/Map/ping")
+            wait_ready(static_port, "/public/")
+
+            for concurrency in args.concurrency:
+                samples, elapsed = run_step(mapgen_port, static_port, args, concurrency)
+                result = summarize(samples, elapsed)
+                result["workers"] = workers if workers is not None else "external"
+                result["concurrency"] = concurrency
+                results.append(result)
+                if not args.json:
+                    print(
+                        f"workers={result['workers']} lobbies={concurrency}: "
+                        f"{result['throughput']} req/s, p99 {result['p99_ms']} ms",
+                        file=sys.stderr,
+                    )
+
+            for process in processes:
+                stop_process(process)
+            processes = []
+    finally:
+        for process in processes:
+            stop_process(process)
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    if args.json:
+        print(
+            json.dumps(
+                {"results": results, "saturation": saturation(results)}, indent=2
+            )
+        )
+    else:
+        print_table(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import os
+import random
+
+# Placement sets mapgen assigns per team count (see Placements.cs)
+TEAM_PLACEMENTS = {
+    0: [],
+    1: ["full"],
+    2: ["top", "bottom"],
+    3: ["top", "bottom-left", "bottom-right"],
+    4: ["top-left", "top-right", "bottom-left", "bottom-right"],
+}
+
+CUSTOM_CONSTRAINTS = {
+    "min_padding": 2,
+    "min_line_width": 2,
+    "min_border_width": 4,
+    "pixel_perfect": False,
+    "fill_board": False,
+}
+
+
+def list_sprites(textures_dir: str) -> list[str]:
+    sprites_dir = os.path.join(textures_dir, "sprites")
+    return [
+        f"sprites/{filename}"
+        for filename in sorted(os.listdir(sprites_dir))
+        if filename.endswith(".png")
+    ]
+
+
+def make_board(
+    rng: random.Random,
+    sprites: list[str],
+    grid_size: int,
+    team_count: int,
+    custom_constraints: bool = False,
+    completion_ratio: float = 0.3,
+) -> dict:
+    teams = [
+        {"name": f"team{i + 1}", "placement": placement}
+        for i, placement in enumerate(TEAM_PLACEMENTS[team_count])
+    ]
+
+    items = []
+    for row in range(grid_size):
+        for column in range(grid_size):
+            items.append(
+                {
+                    "row": row,
+                    "column": column,
+                    "sprite": rng.choice(sprites),
+                    "completed": {
+                        team["name"]: rng.random() < completion_ratio for team in teams
+                    },
+                }
+            )
+
+    settings = {"grid_size": grid_size, "teams": teams}
+    if custom_constraints:
+        settings["constraints"] = dict(CUSTOM_CONSTRAINTS)
+
+    return {"settings": settings, "items": items}
+
+
+def board_matrix(seed: int, sprites: list[str], completion_ratio: float = 0.3):
+    # One board per grid size, team count and constraint mode, reproducible from the seed
+    rng = random.Random(seed)
+    for grid_size in range(1, 10):
+        for team_count in range(0, 5):
+            for custom_constraints in (False, True):
+                board = make_board(
+                    rng,
+                    sprites,
+                    grid_size,
+                    team_count,
+                    custom_constraints,
+                    completion_ratio,
+                )
+                mode = "custom" if custom_constraints else "default"
+                yield f"g{grid_size}-t{team_count}-{mode}", board
@@ -0,0 +1,328 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import socketserver
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+from http.server import BaseHTTPRequestHandler, SimpleHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from payloads import list_sprites
+
+# Local stand-ins for the services around imggen in production:
+#   mapgen  - MapGenerationService: builds items on create, forwards map_raw to /generate
+#   static  - nginx serving the output directory under /public
+#   kv      - Redis (RESP) behind IMGGEN_SHARED_CACHE=redis://host:port
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate sends; with Nagle on, every keep-alive
+    # response would wait ~40 ms for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+
+class MapgenHandler(QuietHandler):
+    # Set by serve_mapgen
+    imggen = None
+    sprites = None
+    connections = threading.local()
+
+    def imggen_post(self, path, body):
+        # One keep-alive connection per server thread, like the pooled HttpClient
+        connection = getattr(self.connections, "connection", None)
+        if connection is None:
+            connection = http.client.HTTPConnection(
+                self.imggen.hostname, self.imggen.port, timeout=120
+            )
+            self.connections.connection = connection
+        try:
+            connection.request(
+                "POST",
+                path,
+                json.dumps(body),
+                {"Content-Type": "application/json"},
+            )
+            response = connection.getresponse()
+            return response.status, json.loads(response.read())
+        except (OSError, http.client.HTTPException, ValueError):
+            connection.close()
+            self.connections.connection = None
+            raise
+
+    def generate(self, settings, items):
+        status, body = self.imggen_post(
+            "/generate", {"settings": settings, "items": items}
+        )
+        if status >= 400:
+            error = body.get("imggen", "Failed to generate image.")
+            self.send_json(400, {"errors": [error]})
+            return None
+        return body
+
+    def create(self, request):
+        settings = request.get("settings") or {}
+        grid_size = settings.get("grid_size", 5)
+        teams = settings.get("teams", [])
+        rng = random.Random()
+        items = [
+            {
+                "row": row,
+                "column": column,
+                "id": f"item{row * grid_size + column}",
+                "name": f"Item {row * grid_size + column}",
+                "sprite": rng.choice(self.sprites),
+                "difficulty": "easy",
+                "completed": {team["name"]: False for team in teams},
+            }
+            for row in range(grid_size)
+            for column in range(grid_size)
+        ]
+        body = self.generate(settings, items)
+        if body is not None:
+            self.send_json(
+                200,
+                {
+                    "map_url": body["map_url"],
+                    "map_raw": {"settings": settings, "items": items},
+                },
+            )
+
+    def update(self, request):
+        map_raw = request.get("map_raw") or request
+        settings = map_raw.get("settings")
+        items = map_raw.get("items")
+        if settings is None or items is None:
+            self.send_json(400, {"errors": "Please provide Settings and Items!"})
+            return
+        body = self.generate(settings, items)
+        if body is not None:
+            self.send_json(200, {"map_url": body["map_url"], "bingo": body["bingo"]})
+
+    def do_GET(self):
+        if self.path == "/Map/ping":
+            self.send_json(200, {"message": "works! (mapgen)"})
+        else:
+            self.send_json(404, {"errors": "Not found."})
+
+    def do_POST(self):
+        routes = {"/Map/create": self.create, "/Map/update": self.update}
+        route = routes.get(self.path)
+        try:
+            request = self.read_json()
+            if route is None:
+                self.send_json(404, {"errors": "Not found."})
+                return
+            route(request)
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            self.send_json(502, {"errors": [f"imggen unavailable: {e}"]})
+
+
+class PublicHandler(SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def translate_path(self, path):
+        # nginx: location /public { alias /app/public/; }
+        if path.startswith("/public/"):
+            path = path[len("/public") :]
+        else:
+            path = "/.missing"
+        return super().translate_path(path)
+
+
+class KeyValueStore:
+    # String values with PX/EX expiry, evicting the least recently used past max_bytes
+    # like Redis with maxmemory-policy allkeys-lru
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def remove(self, key):
+        value, _ = self.entries.pop(key)
+        self.size -= len(key) + len(value)
+
+    def get(self, key, ttl_ms=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                self.remove(key)
+                return None
+            if ttl_ms is not None:
+                self.entries[key] = (value, time.monotonic() + ttl_ms / 1000)
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl_ms=None):
+        expires_at = None if ttl_ms is None else time.monotonic() + ttl_ms / 1000
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (value, expires_at)
+            self.size += len(key) + len(value)
+            while self.max_bytes and self.size > self.max_bytes and self.entries:
+                self.remove(next(iter(self.entries)))
+
+    def delete(self, keys):
+        with self.lock:
+            removed = [key for key in keys if key in self.entries]
+            for key in removed:
+                self.remove(key)
+            return len(removed)
+
+    def flush(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+def expiry_ms(options):
+    # PX milliseconds or EX seconds from the options after the key (and value)
+    if len(options) < 2:
+        return None
+    unit = options[0].upper()
+    if unit == b"PX":
+        return int(options[1])
+    if unit == b"EX":
+        return int(options[1]) * 1000
+    return None
+
+
+class KeyValueHandler(socketserver.StreamRequestHandler):
+    disable_nagle_algorithm = True
+    # Set by serve_kv
+    store = None
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line.startswith(b"*"):
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def reply(self, value):
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def execute(self, args):
+        name, *rest = args
+        match name.upper():
+            case b"PING":
+                return b"+PONG\r\n"
+            case b"GET" if len(rest) == 1:
+                return self.reply(self.store.get(rest[0]))
+            case b"GETEX" if rest:
+                return self.reply(self.store.get(rest[0], expiry_ms(rest[1:])))
+            case b"SET" if len(rest) >= 2:
+                self.store.set(rest[0], rest[1], expiry_ms(rest[2:]))
+                return b"+OK\r\n"
+            case b"DEL" if rest:
+                return self.reply(self.store.delete(rest))
+            case b"DBSIZE":
+                return self.reply(len(self.store.entries))
+            case b"FLUSHALL":
+                self.store.flush()
+                return b"+OK\r\n"
+        return b"-ERR unknown command or wrong number of arguments\r\n"
+
+    def handle(self):
+        while True:
+            try:
+                args = self.read_command()
+            except (OSError, ValueError):
+                return
+            if not args:
+                return
+            try:
+                response = self.execute(args)
+            except ValueError:
+                response = b"-ERR value is not an integer or out of range\r\n"
+            self.wfile.write(response)
+
+
+def serve_mapgen(port, imggen_url, textures_dir):
+    MapgenHandler.imggen = urlsplit(imggen_url)
+    MapgenHandler.sprites = list_sprites(textures_dir)
+    server = ThreadingHTTPServer(("127.0.0.1", port), MapgenHandler)
+    server.daemon_threads = True
+    return server
+
+
+def serve_static(port, directory):
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", port), partial(PublicHandler, directory=directory)
+    )
+    server.daemon_threads = True
+    return server
+
+
+def serve_kv(port, max_bytes):
+    KeyValueHandler.store = KeyValueStore(max_bytes)
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", port), KeyValueHandler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mapgen and nginx stand-ins.")
+    parser.add_argument("service", choices=("mapgen", "static", "kv"))
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--imggen-url", default="http://127.0.0.1:5000")
+    parser.add_argument(
+        "--textures-dir",
+        default=os.path.join(os.path.dirname(os.path.dirname(__file__)), "textures"),
+    )
+    parser.add_argument("--directory", default="/app/public")
+    parser.add_argument(
+        "--max-bytes", type=int, default=256 * 1024 * 1024, help="kv size limit"
+    )
+    args = parser.parse_args()
+
+    if args.service == "mapgen":
+        server = serve_mapgen(args.port, args.imggen_url, args.textures_dir)
+    elif args.service == "kv":
+        server = serve_kv(args.port, args.max_bytes)
+    else:
+        server = serve_static(args.port, args.directory)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+from functools import lru_cache
+
+
+def cell_bit(grid_size, row, column):
+    return 1 << (row * grid_size + column)
+
+
+@lru_cache(maxsize=None)
+def win_lines(grid_size):
+    # Every winning line as (line, mask, cells), in the order bingos were always checked:
+    # row i and column i for each i, then both diagonals
+    lines = []
+    for i in range(grid_size):
+        lines.append(({"type": "row", "index": i}, [(i, j) for j in range(grid_size)]))
+        lines.append(
+            ({"type": "column", "index": i}, [(j, i) for j in range(grid_size)])
+        )
+    lines.append(({"type": "diagonal"}, [(i, i) for i in range(grid_size)]))
+    lines.append(
+        (
+            {"type": "anti_diagonal"},
+            [(i, grid_size - i - 1) for i in range(grid_size)],
+        )
+    )
+
+    return tuple(
+        (line, sum(cell_bit(grid_size, row, column) for row, column in cells), cells)
+        for line, cells in lines
+    )
+
+
+def team_masks(grid_size, items, team_info):
+    # One integer per team, bit row * grid_size + column set for each completed cell
+    masks = dict.fromkeys(team_info, 0)
+    for item in items:
+        row = item["row"]
+        column = item["column"]
+        if row + 1 > grid_size or column + 1 > grid_size:
+            continue
+
+        # Negative positions count from the end, as list indexing always did
+        if row < 0:
+            row += grid_size
+        if column < 0:
+            column += grid_size
+        bit = cell_bit(grid_size, row, column)
+
+        if "completed" in item:
+            for team, value in item.get("completed", {}).items():
+                if value and team in masks:
+                    masks[team] |= bit
+    return masks
+
+
+def evaluate(grid_size, items, team_info):
+    # The winner is the first team, in team order, with a completed line; its first
+    # completed line is the one drawn on the board
+    masks = team_masks(grid_size, items, team_info)
+
+    winner = None
+    winning_line = None
+    lines = {}
+    near_complete = {}
+    for team, mask in masks.items():
+        completed = []
+        near = []
+        for line, line_mask, cells in win_lines(grid_size):
+            missing = line_mask & ~mask
+            if not missing:
+                completed.append((line, cells))
+            elif not missing & (missing - 1):
+                # Exactly one cell of the line is missing
+                index = missing.bit_length() - 1
+                near.append(
+                    {
+                        **line,
+                        "missing": {
+                            "row": index // grid_size,
+                            "column": index % grid_size,
+                        },
+                    }
+                )
+
+        if completed and winner is None:
+            winner = team
+            winning_line = completed[0]
+        lines[team] = [line for line, _ in completed]
+        near_complete[team] = near
+
+    return {
+        "winner": winner,
+        "winning_line": winning_line,
+        "completed": {team: mask.bit_count() for team, mask in masks.items()},
+        "lines": lines,
+        "near_complete": near_complete,
+    }
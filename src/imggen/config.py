@@ -0,0 +1,40 @@
+import os
+
+
+def env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    number = int(value)
+    if number < 0:
+        msg = f"{name} must be >= 0, got {number}"
+        raise ValueError(msg)
+    return number
+
+
+def parse_bool(value: str, name: str) -> bool:
+    normalized = value.strip().lower()
+    if normalized in ("1", "true", "yes", "on"):
+        return True
+    if normalized in ("0", "false", "no", "off"):
+        return False
+    msg = f"{name} must be a boolean, got '{value}'"
+    raise ValueError(msg)
+
+
+def env_bool(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    return parse_bool(value, name)
+
+
+def env_float(name: str, default: float) -> float:
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    number = float(value)
+    if number < 0:
+        msg = f"{name} must be >= 0, got {number}"
+        raise ValueError(msg)
+    return number
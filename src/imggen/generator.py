@@ -1,752 +1,440 @@
+import base64
+import contextvars
+import gc
+import hmac
 import os
-import uuid
-
-from flask import Flask, jsonify, request
-from PIL import Image, ImageColor, ImageDraw
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from flask import Flask, Response, jsonify, request
+
+import metrics
+import profiler
+from config import env_bool, env_int, parse_bool
+from encoding import validate_profile
+from render_engine import QueueFullError, RenderEngine
+from renderer import (
+    OUTPUT_PROFILE,
+    cache_stats,
+    generate_board,
+    parse_board,
+    score_board,
+)
+from sessions import SessionNotFoundError, SessionStore
+from timelapse import (
+    TIMELAPSE_FORMATS,
+    TimelapseTooLongError,
+    frame_count,
+    render_timelapse,
+    validate_format,
+    validate_length,
+)
 
 app = Flask(__name__)
 
-OUTPUT_DIR = "/app/public"
-TEXTURES_DIR = "/app/textures"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-IMG_SIZE = 128
-BASE_ASSET_WIDTH = 32
-DEFAULT_TEAM_NAMES = ["team1", "team2", "team3", "team4"]
-DEFAULT_TEAM_COLORS = [
-    "#64FF64",
-    "#64FFFF",
-    "#FFFF64",
-    "#FF6464",
-]
-
-
-def detect_bingo(grid_size, items, draw, grid_params, team_info):
-    # Grid for each team
-    grid = {
-        team: [[False] * grid_size for _ in range(grid_size)]
-        for team in team_info.keys()
-    }
+RESPONSE_MODES = ("url", "png", "base64", "map")
+# Raw response bodies: the encoded image, or the map item's color bytes
+RAW_RESPONSE_MODES = ("png", "map")
 
-    # Check for item/block completion
-    for item in items:
-        if item["row"] + 1 > grid_size or item["column"] + 1 > grid_size:
-            continue
-        row = item["row"]
-        column = item["column"]
-
-        if "completed" in item:
-            for team, value in item.get("completed", {}).items():
-                if value and team in grid:
-                    grid[team][row][column] = True
-
-    def calculate_cell_coordinates(row, column):
-        x = int(
-            column * grid_params["cell_width"]
-            + grid_params["border_width"]
-            + (grid_params["line_width"] * column)
-        )
-        y = int(
-            row * grid_params["cell_width"]
-            + grid_params["border_width"]
-            + (grid_params["line_width"] * row)
-        )
-        return x, y
-
-    # Check for bingo
-    for team_name in team_info.keys():
-        team_grid = grid[team_name]
-        team_color = team_info[team_name]["color"]
-
-        # Check rows and columns
-        for i in range(grid_size):
-            if all(team_grid[i]):
-                # Row bingo
-                start_x, start_y = calculate_cell_coordinates(i, 0)
-                end_x, end_y = calculate_cell_coordinates(i, grid_size - 1)
-                if grid_size > 1:
-                    draw_bingo_line(
-                        draw,
-                        start_x,
-                        start_y,
-                        end_x,
-                        end_y,
-                        grid_params["cell_width"],
-                        team_color,
-                        grid_params["padding"],
-                    )
-                return team_name
-
-            if all(row[i] for row in team_grid):
-                # Column bingo
-                start_x, start_y = calculate_cell_coordinates(0, i)
-                end_x, end_y = calculate_cell_coordinates(grid_size - 1, i)
-                draw_bingo_line(
-                    draw,
-                    start_x,
-                    start_y,
-                    end_x,
-                    end_y,
-                    grid_params["cell_width"],
-                    team_color,
-                    grid_params["padding"],
-                )
-                return team_name
-
-        # Check diagonals
-        if all(team_grid[i][i] for i in range(grid_size)):
-            # Top-left to bottom-right
-            start_x, start_y = calculate_cell_coordinates(0, 0)
-            end_x, end_y = calculate_cell_coordinates(grid_size - 1, grid_size - 1)
-            draw_bingo_line(
-                draw,
-                start_x,
-                start_y,
-                end_x,
-                end_y,
-                grid_params["cell_width"],
-                team_color,
-                grid_params["padding"],
-            )
-            return team_name
-
-        if all(team_grid[i][grid_size - i - 1] for i in range(grid_size)):
-            # Top-right to bottom-left
-            start_x, start_y = calculate_cell_coordinates(0, grid_size - 1)
-            end_x, end_y = calculate_cell_coordinates(grid_size - 1, 0)
-            draw_bingo_line(
-                draw,
-                start_x,
-                start_y,
-                end_x,
-                end_y,
-                grid_params["cell_width"],
-                team_color,
-                grid_params["padding"],
-            )
-            return team_name
-
-    return None  # No bingo detected
-
-
-def draw_bingo_line(
-    draw, start_cell_x, start_cell_y, end_cell_x, end_cell_y, cell_width, color, padding
-):
-    cx1 = start_cell_x + cell_width // 2
-    cy1 = start_cell_y + cell_width // 2
-    cx2 = end_cell_x + cell_width // 2
-    cy2 = end_cell_y + cell_width // 2
-
-    # main line
-    draw.line(
-        [(cx1, cy1), (cx2, cy2)],
-        fill=color,
-        width=padding,
-    )
+# Routes whose requests can be picked for stack sampling
+PROFILED_ROUTES = (
+    "/generate",
+    "/generate/batch",
+    "/sessions",
+    "/sessions/<session_id>",
+)
 
-    # round caps
-    r = padding // 2
+# Admin endpoints are disabled unless a token is configured
+ADMIN_TOKEN = os.environ.get("IMGGEN_ADMIN_TOKEN") or None
 
-    draw.ellipse(
-        [cx1 - r, cy1 - r, cx1 + r, cy1 + r],
-        fill=color,
-    )
-    draw.ellipse(
-        [cx2 - r, cy2 - r, cx2 + r, cy2 + r],
-        fill=color,
-    )
+BATCH_MAX_BOARDS = env_int("IMGGEN_BATCH_MAX_BOARDS", 100)
+BATCH_WORKERS = env_int("IMGGEN_BATCH_WORKERS", os.cpu_count() or 1) or 1
 
+# Writing to OUTPUT_DIR can be turned off for callers that take the image bytes directly
+PERSIST_OUTPUT = env_bool("IMGGEN_PERSIST_OUTPUT", True)
 
-def draw_line(draw, types, cell_x, cell_y, cell_width, color, padding):
-    for type in types:
-        match type:
-            case "top-left":
-                # Horizontal line
-                draw.polygon(
-                    [
-                        (cell_x, cell_y),
-                        (cell_x + (cell_width // 2) - 1, cell_y),
-                        (cell_x + (cell_width // 2) - 1, cell_y + padding - 1),
-                        (cell_x, cell_y + padding - 1),
-                    ],
-                    fill=color,
-                )
-                # Vertical line
-                draw.polygon(
-                    [
-                        (cell_x, cell_y),
-                        (cell_x + padding - 1, cell_y),
-                        (cell_x + padding - 1, cell_y + (cell_width // 2) - 1),
-                        (cell_x, cell_y + (cell_width // 2) - 1),
-                    ],
-                    fill=color,
-                )
-            case "top-right":
-                # Horizontal line
-                draw.polygon(
-                    [
-                        (cell_x + (cell_width // 2), cell_y),
-                        (cell_x + cell_width - 1, cell_y),
-                        (cell_x + cell_width - 1, cell_y + padding - 1),
-                        (cell_x + (cell_width // 2), cell_y + padding - 1),
-                    ],
-                    fill=color,
-                )
-                # Vertical line
-                draw.polygon(
-                    [
-                        (cell_x + cell_width - padding, cell_y),
-                        (cell_x + cell_width - 1, cell_y),
-                        (cell_x + cell_width - 1, cell_y + (cell_width // 2) - 1),
-                        (cell_x + cell_width - padding, cell_y + (cell_width // 2) - 1),
-                    ],
-                    fill=color,
-                )
-            case "bottom-left":
-                # Horizontal line
-                draw.polygon(
-                    [
-                        (cell_x, cell_y + cell_width - padding),
-                        (cell_x + (cell_width // 2) - 1, cell_y + cell_width - padding),
-                        (cell_x + (cell_width // 2) - 1, cell_y + cell_width - 1),
-                        (cell_x, cell_y + cell_width - 1),
-                    ],
-                    fill=color,
-                )
-                # Vertical line
-                draw.polygon(
-                    [
-                        (cell_x, cell_y + (cell_width // 2)),
-                        (cell_x + padding - 1, cell_y + (cell_width // 2)),
-                        (cell_x + padding - 1, cell_y + cell_width - 1),
-                        (cell_x, cell_y + cell_width - 1),
-                    ],
-                    fill=color,
-                )
-            case "bottom-right":
-                # Horizontal line
-                draw.polygon(
-                    [
-                        (cell_x + (cell_width // 2), cell_y + cell_width - padding),
-                        (cell_x + cell_width - 1, cell_y + cell_width - padding),
-                        (cell_x + cell_width - 1, cell_y + cell_width - 1),
-                        (cell_x + (cell_width // 2), cell_y + cell_width - 1),
-                    ],
-                    fill=color,
-                )
-                # Vertical line
-                draw.polygon(
-                    [
-                        (cell_x + cell_width - padding, cell_y + (cell_width // 2)),
-                        (cell_x + cell_width - 1, cell_y + (cell_width // 2)),
-                        (cell_x + cell_width - 1, cell_y + cell_width - 1),
-                        (cell_x + cell_width - padding, cell_y + cell_width - 1),
-                    ],
-                    fill=color,
-                )
-            case _:
-                continue
-
-
-def compute_grid_params(grid_size: int, constraints: dict) -> dict[str, int]:
-    errors = []
-
-    min_padding = constraints.get("min_padding", 0)
-    max_padding = constraints.get("max_padding", None)
-    min_line_width = constraints.get("min_line_width", 0)
-    max_line_width = constraints.get("max_line_width", None)
-    min_border_width = constraints.get("min_border_width", 0)
-    max_border_width = constraints.get("max_border_width", None)
-    pixel_perfect = constraints.get("pixel_perfect", True)
-    fill_board = constraints.get("fill_board", True)
-
-    int_keys = [
-        "min_padding",
-        "max_padding",
-        "min_line_width",
-        "max_line_width",
-        "min_border_width",
-        "max_border_width",
-    ]
-    bool_keys = ["pixel_perfect", "fill_board", "center_board"]
-    min_max_pairs = [
-        ("min_padding", "max_padding"),
-        ("min_line_width", "max_line_width"),
-        ("min_border_width", "max_border_width"),
-    ]
-
-    for key in int_keys:
-        value = constraints.get(key, None)
-        if value is not None and not isinstance(value, int):
-            errors.append(
-                f"Constraints: '{key}': Expected integer, got {type(value).__name__}"
-            )
-        elif isinstance(value, int) and value < 0:
-            errors.append(f"Constraints: '{key}': Must be >= 0, got {value}")
-
-    for key in bool_keys:
-        value = constraints.get(key, None)
-        if value is not None and not isinstance(value, bool):
-            errors.append(
-                f"Constraints: '{key}': Expected boolean, got {type(value).__name__}"
-            )
-
-    for min_key, max_key in min_max_pairs:
-        min_value = constraints.get(min_key, 0)
-        max_value = constraints.get(max_key, None)
-        if isinstance(min_value, int) and isinstance(max_value, int):
-            if max_value is not None and min_value > max_value:
-                errors.append(
-                    f"Constraints: '{min_key}': Cannot be greater than '{max_key}' ({min_value} > {max_value})"
-                )
+# Rendering runs in a pool of worker processes behind a bounded queue (inline when 0;
+# gunicorn.conf.py sizes the pool for the deployed server)
+render_engine = RenderEngine(
+    processes=env_int("IMGGEN_RENDER_PROCESSES", 0),
+    queue_size=env_int("IMGGEN_RENDER_QUEUE_SIZE", 32),
+    preload=["renderer"],
+    stats_fn=cache_stats,
+)
+RENDER_TIMEOUT = env_int("IMGGEN_RENDER_TIMEOUT", 50)
+metrics.registry.register_gauges(render_engine.gauges)
 
-    if errors:
-        raise ValueError(errors)
+# Live boards updated by deltas; without a shared directory each worker has its own
+session_store = SessionStore(
+    os.environ.get("IMGGEN_SESSION_DIR") or None,
+    maxsize=env_int("IMGGEN_SESSION_CACHE_SIZE", 1024),
+    max_age=env_int("IMGGEN_SESSION_MAX_AGE", 7 * 24 * 60 * 60),
+    gc_interval=env_int("IMGGEN_SESSION_GC_INTERVAL", 5 * 60),
+    # Changes kept for timelapse exports; older ones are folded into the first frame
+    max_history=env_int("IMGGEN_SESSION_MAX_HISTORY", 500),
+    # Deltas appended to a session's log before it is folded into the snapshot
+    compact_every=env_int("IMGGEN_SESSION_COMPACT_EVERY", 64),
+)
+TIMELAPSE_FRAME_MS = (20, 10000)
+# Longer webp exports are rejected; gif and apng encode one frame at a time
+TIMELAPSE_WEBP_MAX_FRAMES = env_int("IMGGEN_TIMELAPSE_WEBP_MAX_FRAMES", 100)
 
-    def is_pixel_perfect(asset_width: int) -> bool:
-        return (
-            asset_width % BASE_ASSET_WIDTH == 0 or BASE_ASSET_WIDTH % asset_width == 0
-        )
+# Keep preloaded objects out of the collector so forked workers don't copy their pages
+gc.freeze()
 
-    def evaluate() -> tuple[bool, dict[str, int]]:
-        asset_width = cell_width - padding * 2
 
-        if asset_width <= 0:
-            return False, {}
+@app.before_request
+def start_request_metrics():
+    metrics.start_request()
+    if request.url_rule and request.url_rule.rule in PROFILED_ROUTES:
+        profiler.start_request()
 
-        if pixel_perfect and not is_pixel_perfect(asset_width):
-            return False, {}
 
-        score = (
-            asset_width * 1000
-            - (padding - min_padding) * 20
-            - (line_width - min_line_width) * 10
-            - (border_width - min_border_width) * 10
-        )
+@app.teardown_request
+def finish_request_profile(_):
+    profiler.finish_request()
+
+
+@app.after_request
+def finish_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.finish_request(route, response.status_code)
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return Response(metrics.render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+def is_admin(headers):
+    token = headers.get("X-Admin-Token", "")
+    return ADMIN_TOKEN is not None and hmac.compare_digest(token, ADMIN_TOKEN)
+
+
+@app.route("/admin/profile", methods=["GET", "POST"])
+def admin_profile():
+    if not is_admin(request.headers):
+        return jsonify({"imggen": "Admin token missing or invalid."}), 403
 
-        return True, {
-            "cell_width": cell_width,
-            "asset_width": asset_width,
-            "padding": padding,
-            "line_width": line_width,
-            "border_width": border_width,
-            "score": score,
-        }
-
-    if max_line_width is None:
-        max_line_width = IMG_SIZE
-    if max_border_width is None:
-        max_border_width = IMG_SIZE
-    if max_padding is None:
-        max_padding = IMG_SIZE // 2
-
-    best = None
-
-    for border_width in range(min_border_width, max_border_width + 1):
-        if max_border_width == 0:
-            border_width = 0
-        for line_width in range(min_line_width, max_line_width + 1):
-            if max_line_width == 0:
-                line_width = 0
-            total_lines = line_width * (grid_size - 1)
-            total_borders = border_width * 2
-            remaining = IMG_SIZE - total_lines - total_borders
-
-            if remaining <= 0:
-                continue
-
-            cell_width_candidates = []
-
-            if fill_board:
-                if remaining % grid_size != 0:
-                    continue
-                cw = remaining // grid_size
-                cell_width_candidates.append(cw)
-            else:
-                cell_width_candidates = list(range(1, remaining // grid_size + 1))
-
-            for cell_width in cell_width_candidates:
-                mp = min(max_padding, cell_width // 2)
-
-                for padding in range(min_padding, mp + 1):
-                    if mp == 0:
-                        padding = 0
-
-                    valid, candidate = evaluate()
-                    if not valid:
-                        continue
-
-                    if best is None or candidate["score"] > best["score"]:
-                        best = candidate
-
-    if best is None:
-        msg = "No valid grid configuration found under given constraints."
+    try:
+        if request.method == "POST":
+            data = request.get_json()
+            profiler.set_rate(data.get("rate"))
+        return jsonify(profiler.stats()), 200
+
+    except Exception as e:
+        return jsonify({"imggen": str(e)}), 500
+
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    body = cache_stats()
+    body["render_engine"] = render_engine.stats()
+    # With a process pool the caches above are idle; each process reports its own
+    body["render_workers"] = dict(render_engine.worker_stats)
+    body["sessions"] = session_store.stats()
+    return jsonify(body), 200
+
+
+def run_render(fn, *args, block=False):
+    try:
+        return render_engine.run(fn, *args, block=block, timeout=RENDER_TIMEOUT)
+    except FutureTimeoutError:
+        msg = f"Rendering timed out after {RENDER_TIMEOUT} seconds."
+        raise TimeoutError(msg) from None
+
+
+def render(board, response_mode, persist, profile, map_colors, block=False):
+    return run_render(
+        generate_board,
+        board,
+        persist,
+        response_mode in ("png", "base64"),
+        profile,
+        map_colors,
+        block=block,
+    )
+
+
+def parse_output_options(args):
+    response_mode = args.get("response", "url").lower()
+    if response_mode not in RESPONSE_MODES:
+        msg = f"Invalid response mode '{response_mode}' (expected one of {', '.join(RESPONSE_MODES)})."
+        raise ValueError(msg)
+
+    persist = PERSIST_OUTPUT
+    if "persist" in args:
+        persist = parse_bool(args["persist"], "persist")
+
+    if response_mode == "url" and not persist:
+        msg = "Response mode 'url' requires the image to be persisted."
         raise ValueError(msg)
 
-    best.pop("score")
-    return best
-
-
-pre_computed_grid_params = {
-    1: compute_grid_params(
-        1,
-        {
-            "min_padding": 8,
-            "min_line_width": 0,
-            "min_border_width": 8,
-            "pixel_perfect": True,
-        },
-    ),
-    2: compute_grid_params(
-        2,
-        {
-            "min_padding": 3,
-            "min_line_width": 7,
-            "min_border_width": 9,
-            "pixel_perfect": True,
-        },
-    ),
-    3: compute_grid_params(
-        3,
-        {
-            "min_padding": 1,
-            "min_line_width": 3,
-            "min_border_width": 3,
-            "pixel_perfect": True,
-        },
-    ),
-    4: compute_grid_params(
-        4,
-        {
-            "min_padding": 1,
-            "min_line_width": 1,
-            "min_border_width": 3,
-            "pixel_perfect": True,
-        },
-    ),
-    5: compute_grid_params(
-        5,
-        {
-            "min_padding": 1,
-            "min_line_width": 1,
-            "min_border_width": 3,
-            "pixel_perfect": True,
-        },
-    ),
-    6: compute_grid_params(
-        6,
-        {
-            "min_padding": 1,
-            "min_line_width": 1,
-            "min_border_width": 1,
-            "pixel_perfect": True,
-        },
-    ),
-    7: compute_grid_params(
-        7,
-        {
-            "min_padding": 1,
-            "min_line_width": 1,
-            "min_border_width": 1,
-            "pixel_perfect": False,
-        },
-    ),
-    8: compute_grid_params(
-        8,
-        {
-            "min_padding": 1,
-            "min_line_width": 1,
-            "min_border_width": 1,
-            "pixel_perfect": False,
-        },
-    ),
-    9: compute_grid_params(
-        9,
-        {
-            "min_padding": 1,
-            "min_line_width": 1,
-            "min_border_width": 1,
-            "pixel_perfect": False,
-        },
-    ),
-}
+    profile = validate_profile(args.get("profile", OUTPUT_PROFILE).lower())
+
+    # Minecraft map color bytes, as the whole response or next to the other fields
+    map_colors = response_mode == "map"
+    if "map_colors" in args:
+        map_colors = map_colors or parse_bool(args["map_colors"], "map_colors")
+
+    return response_mode, persist, profile, map_colors
+
+
+def response_body(result, response_mode):
+    body = {
+        "map_url": result["map_url"],
+        "bingo": result["bingo"],
+        "bingo_lines": result["bingo_lines"],
+        "near_complete": result["near_complete"],
+        "profile": result["profile"],
+        "content_type": result["content_type"],
+    }
+    if response_mode == "base64":
+        body["image"] = base64.b64encode(result["image"]).decode("ascii")
+    if "map_colors" in result:
+        body["map_colors"] = base64.b64encode(result["map_colors"]).decode("ascii")
+    return body
+
+
+def response_parts(result, response_mode):
+    # Framework independent response: (status, body, content_type, headers). The body is
+    # the raw bytes for raw modes and a JSON object otherwise, encoded by the caller
+    status = 201 if result["map_url"] else 200
+    if response_mode not in RAW_RESPONSE_MODES:
+        return status, response_body(result, response_mode), "application/json", {}
+
+    # Raw image bytes; the type follows the output profile, so webp is possible here
+    headers = {
+        "X-Bingo": result["bingo"] or "",
+        "X-Image-Profile": result["profile"],
+    }
+    if result["map_url"]:
+        headers["X-Map-Url"] = result["map_url"]
+    if response_mode == "map":
+        # One byte per pixel, row by row, as a 128x128 map item stores its colors
+        return status, result["map_colors"], "application/octet-stream", headers
+    return status, result["image"], result["content_type"], headers
+
+
+def build_response(result, response_mode):
+    status, body, content_type, headers = response_parts(result, response_mode)
+    if content_type == "application/json":
+        return jsonify(body), status
+    return Response(body, status=status, mimetype=content_type, headers=headers)
 
 
 @app.route("/generate", methods=["POST"])
 def generate_image():
     try:
-        data = request.get_json()
+        with metrics.stage("parse_json"):
+            data = request.get_json()
+
+        response_mode, persist, profile, map_colors = parse_output_options(request.args)
+        board = parse_board(data)
+        result = render(board, response_mode, persist, profile, map_colors)
+
+        # Return URL, or the encoded image itself
+        return build_response(result, response_mode)
+
+    except QueueFullError as e:
+        metrics.record_error(e)
+        return jsonify({"imggen": str(e)}), 429, {"Retry-After": "1"}
+
+    except Exception as e:
+        metrics.record_error(e)
+        return jsonify({"imggen": str(e)}), 500
+
+
+@app.route("/evaluate", methods=["POST"])
+def evaluate_board():
+    try:
+        with metrics.stage("parse_json"):
+            data = request.get_json()
+
+        # Scored in the request thread; nothing is rendered, so the engine is skipped
+        board = parse_board(data)
+        return jsonify(score_board(board)), 200
 
-        settings = data.get("settings", {})
-        items = data.get("items", [])
+    except Exception as e:
+        metrics.record_error(e)
+        return jsonify({"imggen": str(e)}), 500
 
-        if not settings and not items:
-            settings = data.get("map_raw", {}).get("settings", {})
-            items = data.get("map_raw", {}).get("items", [])
 
-        grid_size = settings.get("grid_size", 5)
-        teams = settings.get("teams", [])
-        constraints = settings.get("constraints", {})
+@app.route("/generate/batch", methods=["POST"])
+def generate_batch():
+    try:
+        with metrics.stage("parse_json"):
+            data = request.get_json()
 
-        if grid_size < 1 or grid_size > 9:
-            msg = "Invalid grid size entered (grid_size in 'settings' section)."
+        response_mode, persist, profile, map_colors = parse_output_options(request.args)
+        if response_mode in RAW_RESPONSE_MODES:
+            msg = f"Response mode '{response_mode}' is not supported for batches, use 'base64'."
             raise ValueError(msg)
 
-        team_info = {}
-        invalid_colors = []
+        payloads = data.get("boards", [])
+        if not isinstance(payloads, list) or not payloads:
+            msg = "Expected a non-empty list of boards ('boards' section)."
+            raise ValueError(msg)
+        if len(payloads) > BATCH_MAX_BOARDS:
+            msg = f"Too many boards in batch ({len(payloads)} > {BATCH_MAX_BOARDS})."
+            raise ValueError(msg)
 
-        for i, team in enumerate(teams):
-            team_name = team.get("name", DEFAULT_TEAM_NAMES[i])
-            team_placement = team.get("placement", None)
-            team_color = str(team.get("color") or DEFAULT_TEAM_COLORS[i])
+        # Parse sequentially so colors and grid params are shared across the batch
+        memo = {}
+        boards = []
+        results = [None] * len(payloads)
+        for index, payload in enumerate(payloads):
             try:
-                ImageColor.getrgb(team_color)
-            except (ValueError, TypeError):
-                invalid_colors.append(team_color)
-
-            team_info[team_name] = {
-                "name": team_name,
-                "placement": team_placement,
-                "color": team_color,
-            }
-
-        # Colors
-        custom_colors = settings.get("colors", {})
-        bg_color = str(
-            custom_colors.get("bg_color", None)
-            or custom_colors.get("background_color", None)
-            or "#D6BE96"
-        )  # Light Beige
-        outer_bg_color = str(
-            custom_colors.get("outer_bg_color", None)
-            or custom_colors.get("outer_background_color", None)
-            or bg_color
-            or "#D6BE96"
-        )  # Light Beige
-        fg_color = str(
-            custom_colors.get("fg_color", None)
-            or custom_colors.get("foreground_color", None)
-            or "#99876C"
-        )  # Dark Beige
-        line_color = str(custom_colors.get("line_color", None) or fg_color)
-        border_color = str(custom_colors.get("border_color", None) or fg_color)
-
-        colors = [bg_color, fg_color, line_color, border_color]
-
-        for color in colors:
+                boards.append((index, parse_board(payload, memo)))
+            except Exception as e:
+                metrics.record_error(e)
+                results[index] = {"imggen": str(e)}
+
+        def render_entry(index_board):
+            index, board = index_board
             try:
-                ImageColor.getrgb(color)
-            except (ValueError, TypeError):
-                invalid_colors.append(color)
+                # Batches wait for queue slots instead of being rejected
+                result = render(
+                    board, response_mode, persist, profile, map_colors, block=True
+                )
+            except Exception as e:
+                metrics.record_error(e)
+                return index, {"imggen": str(e)}
 
-        if invalid_colors:
-            msg = f"Invalid colors provided: {', '.join(invalid_colors)}"
-            raise ValueError(msg)
+            return index, response_body(result, response_mode)
 
-        # Dimensions
-        recompute_keys = {
-            "min_padding",
-            "max_padding",
-            "min_line_width",
-            "max_line_width",
-            "min_border_width",
-            "max_border_width",
-            "pixel_perfect",
-            "fill_board",
-        }
-
-        should_recompute = (
-            constraints
-            and any(key in constraints for key in recompute_keys)
-        )
+        # Pool threads run in a copy of this context, so stage timings reach the request
+        context = contextvars.copy_context()
 
-        if should_recompute:
-            grid_params = compute_grid_params(
-                grid_size=grid_size,
-                constraints=constraints,
-            )
-        else:
-            grid_params = pre_computed_grid_params.get(grid_size, None)
-
-        # Create the base image
-        image = Image.new("RGBA", (IMG_SIZE, IMG_SIZE), bg_color)
-        draw = ImageDraw.Draw(image)
-
-        used_width = (
-            grid_params["cell_width"] * grid_size
-            + grid_params["line_width"] * (grid_size - 1)
-            + grid_params["border_width"] * 2
-        )
+        def run_entry(index_board):
+            return context.copy().run(render_entry, index_board)
 
-        # Grid lines
-        if grid_params["line_width"] > 0:
-            for i in range(grid_size - 1):
-                # Vertical lines
-                x = (
-                    grid_params["border_width"]
-                    + (i + 1) * grid_params["cell_width"]
-                    + i * grid_params["line_width"]
-                )
-                draw.polygon(
-                    [
-                        (x, 0),
-                        (x + grid_params["line_width"] - 1, 0),
-                        (x + grid_params["line_width"] - 1, used_width - 1),
-                        (x, used_width - 1),
-                    ],
-                    fill=line_color,
-                )
+        with ThreadPoolExecutor(
+            max_workers=min(BATCH_WORKERS, len(boards) or 1)
+        ) as pool:
+            for index, body in pool.map(run_entry, boards):
+                results[index] = body
 
-                # Horizontal lines
-                y = (
-                    grid_params["border_width"]
-                    + (i + 1) * grid_params["cell_width"]
-                    + i * grid_params["line_width"]
-                )
-                draw.polygon(
-                    [
-                        (0, y),
-                        (used_width - 1, y),
-                        (used_width - 1, y + grid_params["line_width"] - 1),
-                        (0, y + grid_params["line_width"] - 1),
-                    ],
-                    fill=line_color,
-                )
+        errors = sum(1 for result in results if "imggen" in result)
+        status = 201 if not errors else 207
+        return jsonify({"results": results, "errors": errors}), status
+
+    except Exception as e:
+        metrics.record_error(e)
+        return jsonify({"imggen": str(e)}), 500
+
+
+def build_session_response(session_id, version, result, response_mode, status):
+    if response_mode in RAW_RESPONSE_MODES:
+        response = build_response(result, response_mode)
+        response.status_code = status
+        response.headers["X-Session-Id"] = session_id
+        response.headers["X-Session-Version"] = str(version)
+        return response
+
+    body = {"session_id": session_id, "version": version}
+    body.update(response_body(result, response_mode))
+    return jsonify(body), status
 
-        # Border
-        if grid_params["border_width"] > 0:
-            draw.rectangle(
-                (0, 0, used_width - 1, used_width - 1),
-                outline=border_color,
-                width=grid_params["border_width"],
-            )
-
-        # Add images from textures
-        for item in items:
-            if item["row"] + 1 > grid_size or item["column"] + 1 > grid_size:
-                continue
-            row = item["row"]
-            column = item["column"]
-            texture_name = item["sprite"]
-
-            completed_teams = []
-
-            if "completed" in item:
-                completed_teams = [
-                    team for team, value in item.get("completed", {}).items() if value
-                ]
-
-            # Path to texture
-            texture_path = os.path.join(TEXTURES_DIR, f"{texture_name}")
-
-            # Check if texture exists
-            if not os.path.exists(texture_path):
-                msg = f"Invalid texture {texture_name} provided."
-                raise ValueError(msg)
-
-            # Open texture
-            texture_image = Image.open(texture_path)
-
-            # Convert to RGBA
-            if texture_image.mode != "RGBA":
-                texture_image = texture_image.convert("RGBA")
-
-            # Calculate texture position on grid
-            cell_x = grid_params["border_width"] + column * (
-                grid_params["cell_width"] + grid_params["line_width"]
-            )
-            cell_y = grid_params["border_width"] + row * (
-                grid_params["cell_width"] + grid_params["line_width"]
-            )
-
-            x0 = cell_x + grid_params["padding"]
-            y0 = cell_y + grid_params["padding"]
-
-            # Might stretch texture, but ensures good styling
-            x1 = x0 + grid_params["asset_width"]
-            y1 = y0 + grid_params["asset_width"]
-
-            texture_image = texture_image.resize(
-                (x1 - x0, y1 - y0), resample=Image.Resampling.NEAREST
-            )
-
-            # Paste texture on map image
-            image.paste(texture_image, (x0, y0), texture_image)
-
-            # Item / Block completion
-            if completed_teams:
-                for completed_team in completed_teams:
-                    rectColor = team_info[completed_team]["color"]
-                    placement = team_info[completed_team]["placement"]
-
-                    if not rectColor or not placement:
-                        msg = f"Invalid team key entered ({completed_team} in 'completed' section of '{texture_name}' [row {row}, column {column}])."
-                        raise ValueError(msg)
-
-                    types: list[str] = []
-                    if grid_params["padding"] > 0:
-                        match placement:
-                            case "top":
-                                types.append("top-left")
-                                types.append("top-right")
-                            case "bottom":
-                                types.append("bottom-left")
-                                types.append("bottom-right")
-                            case "left":
-                                types.append("top-left")
-                                types.append("bottom-left")
-                            case "right":
-                                types.append("top-right")
-                                types.append("bottom-right")
-                            case "full":
-                                draw.rectangle(
-                                    (
-                                        cell_x,
-                                        cell_y,
-                                        cell_x + grid_params["cell_width"] - 1,
-                                        cell_y + grid_params["cell_width"] - 1,
-                                    ),
-                                    outline=rectColor,
-                                    width=grid_params["padding"],
-                                )
-                            case _:
-                                types.append(placement)
-
-                        draw_line(
-                            draw,
-                            types,
-                            cell_x,
-                            cell_y,
-                            grid_params["cell_width"],
-                            rectColor,
-                            grid_params["padding"],
-                        )
-
-        # Detect and draw bingo
-        bingo_result = detect_bingo(
-            grid_size,
-            items,
-            draw,
-            grid_params,
-            team_info,
+
+@app.route("/sessions", methods=["POST"])
+def create_session():
+    try:
+        with metrics.stage("parse_json"):
+            data = request.get_json()
+
+        response_mode, persist, profile, map_colors = parse_output_options(request.args)
+        session_id, version, board = session_store.create(data)
+        result = render(board, response_mode, persist, profile, map_colors)
+
+        return build_session_response(session_id, version, result, response_mode, 201)
+
+    except QueueFullError as e:
+        metrics.record_error(e)
+        return jsonify({"imggen": str(e)}), 429, {"Retry-After": "1"}
+
+    except Exception as e:
+        metrics.record_error(e)
+        return jsonify({"imggen": str(e)}), 500
+
+
+@app.route("/sessions/<session_id>", methods=["GET", "PATCH", "DELETE"])
+def manage_session(session_id):
+    try:
+        if request.method == "DELETE":
+            session_store.delete(session_id)
+            return jsonify({"session_id": session_id, "deleted": True}), 200
+
+        if request.method == "GET":
+            # Current bingo state only, like /evaluate
+            version, board = session_store.get(session_id)
+            body = {"session_id": session_id, "version": version}
+            body.update(score_board(board))
+            return jsonify(body), 200
+
+        with metrics.stage("parse_json"):
+            data = request.get_json()
+
+        # Only the changed cells are sent; the rest of the board is kept here
+        response_mode, persist, profile, map_colors = parse_output_options(request.args)
+        version, board = session_store.update(session_id, data.get("changes"))
+        result = render(board, response_mode, persist, profile, map_colors)
+
+        return build_session_response(session_id, version, result, response_mode, 200)
+
+    except SessionNotFoundError as e:
+        metrics.record_error(e)
+        return jsonify({"imggen": str(e)}), 404
+
+    except QueueFullError as e:
+        metrics.record_error(e)
+        return jsonify({"imggen": str(e)}), 429, {"Retry-After": "1"}
+
+    except Exception as e:
+        metrics.record_error(e)
+        return jsonify({"imggen": str(e)}), 500
+
+
+@app.route("/sessions/<session_id>/timelapse", methods=["GET"])
+def session_timelapse(session_id):
+    try:
+        timelapse_format = validate_format(request.args.get("format", "gif").lower())
+        duration = int(request.args.get("frame_ms", 500))
+        if not TIMELAPSE_FRAME_MS[0] <= duration <= TIMELAPSE_FRAME_MS[1]:
+            msg = f"frame_ms must be between {TIMELAPSE_FRAME_MS[0]} and {TIMELAPSE_FRAME_MS[1]}."
+            raise ValueError(msg)
+
+        timeline = validate_length(
+            session_store.timeline(session_id),
+            timelapse_format,
+            TIMELAPSE_WEBP_MAX_FRAMES,
+        )
+        # Frames are rendered and encoded by the render engine, behind its queue
+        animation = run_render(render_timelapse, timeline, timelapse_format, duration)
+        return Response(
+            animation,
+            mimetype=TIMELAPSE_FORMATS[timelapse_format],
+            headers={
+                "X-Session-Id": session_id,
+                "X-Session-Version": str(timeline[0] + len(timeline[3])),
+            },
         )
 
-        center_board = constraints.get("center_board", True)
-        if center_board and used_width != IMG_SIZE:
-            offset = (IMG_SIZE - used_width) // 2
-            image = image.crop((0, 0, used_width, used_width))
-            new_canvas = Image.new("RGBA", (IMG_SIZE, IMG_SIZE), outer_bg_color)
-            new_canvas.paste(image, (offset, offset))
-            image = new_canvas
+    except SessionNotFoundError as e:
+        metrics.record_error(e)
+        return jsonify({"imggen": str(e)}), 404
 
-        # Save image
-        filename = f"{uuid.uuid4()}.png"
-        filepath = os.path.join(OUTPUT_DIR, filename)
-        image.save(filepath)
+    except TimelapseTooLongError as e:
+        metrics.record_error(e)
+        return jsonify({"imggen": str(e)}), 422
 
-        # Return URL
-        return jsonify({"map_url": f"/public/{filename}", "bingo": bingo_result}), 201
+    except QueueFullError as e:
+        metrics.record_error(e)
+        return jsonify({"imggen": str(e)}), 429, {"Retry-After": "1"}
 
     except Exception as e:
+        metrics.record_error(e)
         return jsonify({"imggen": str(e)}), 500
 
 
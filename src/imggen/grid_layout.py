@@ -0,0 +1,305 @@
+import functools
+import os
+
+from layout_table import DEFAULT_PATH, LayoutTable
+
+IMG_SIZE = 128
+BASE_ASSET_WIDTH = 32
+
+# Loaded lazily on the first lookup; without the file every layout is solved
+layout_table = LayoutTable(
+    os.environ.get("IMGGEN_LAYOUT_TABLE") or DEFAULT_PATH, IMG_SIZE
+)
+
+
+def compute_grid_params(grid_size: int, constraints: dict) -> dict[str, int]:
+    errors = []
+
+    min_padding = constraints.get("min_padding", 0)
+    max_padding = constraints.get("max_padding", None)
+    min_line_width = constraints.get("min_line_width", 0)
+    max_line_width = constraints.get("max_line_width", None)
+    min_border_width = constraints.get("min_border_width", 0)
+    max_border_width = constraints.get("max_border_width", None)
+    pixel_perfect = constraints.get("pixel_perfect", True)
+    fill_board = constraints.get("fill_board", True)
+
+    int_keys = [
+        "min_padding",
+        "max_padding",
+        "min_line_width",
+        "max_line_width",
+        "min_border_width",
+        "max_border_width",
+    ]
+    bool_keys = ["pixel_perfect", "fill_board", "center_board"]
+    min_max_pairs = [
+        ("min_padding", "max_padding"),
+        ("min_line_width", "max_line_width"),
+        ("min_border_width", "max_border_width"),
+    ]
+
+    for key in int_keys:
+        value = constraints.get(key, None)
+        if value is not None and not isinstance(value, int):
+            errors.append(
+                f"Constraints: '{key}': Expected integer, got {type(value).__name__}"
+            )
+        elif isinstance(value, int) and value < 0:
+            errors.append(f"Constraints: '{key}': Must be >= 0, got {value}")
+
+    for key in bool_keys:
+        value = constraints.get(key, None)
+        if value is not None and not isinstance(value, bool):
+            errors.append(
+                f"Constraints: '{key}': Expected boolean, got {type(value).__name__}"
+            )
+
+    for min_key, max_key in min_max_pairs:
+        min_value = constraints.get(min_key, 0)
+        max_value = constraints.get(max_key, None)
+        if isinstance(min_value, int) and isinstance(max_value, int):
+            if max_value is not None and min_value > max_value:
+                errors.append(
+                    f"Constraints: '{min_key}': Cannot be greater than '{max_key}' ({min_value} > {max_value})"
+                )
+
+    if errors:
+        raise ValueError(errors)
+
+    # Constraints that only set min_* widths are answered from the prebuilt table
+    if max_padding is None and max_line_width is None and max_border_width is None:
+        found, best = layout_table.lookup(
+            grid_size,
+            min_padding,
+            min_line_width,
+            min_border_width,
+            bool(pixel_perfect),
+            bool(fill_board),
+        )
+        if found:
+            if best is None:
+                msg = "No valid grid configuration found under given constraints."
+                raise ValueError(msg)
+            return best
+
+    if max_line_width is None:
+        max_line_width = IMG_SIZE
+    if max_border_width is None:
+        max_border_width = IMG_SIZE
+    if max_padding is None:
+        max_padding = IMG_SIZE // 2
+
+    best = solve_grid_params(
+        grid_size,
+        min_padding,
+        max_padding,
+        min_line_width,
+        max_line_width,
+        min_border_width,
+        max_border_width,
+        bool(pixel_perfect),
+        bool(fill_board),
+    )
+
+    if best is None:
+        msg = "No valid grid configuration found under given constraints."
+        raise ValueError(msg)
+
+    return dict(best)
+
+
+def is_pixel_perfect(asset_width: int) -> bool:
+    return asset_width % BASE_ASSET_WIDTH == 0 or BASE_ASSET_WIDTH % asset_width == 0
+
+
+# Widest first, so the first fit for a cell is the one with the least padding
+PIXEL_PERFECT_ASSET_WIDTHS = [
+    asset_width
+    for asset_width in range(IMG_SIZE, 0, -1)
+    if is_pixel_perfect(asset_width)
+]
+
+
+def smallest_padding(cell_width, min_padding, max_padding, pixel_perfect):
+    # Less padding always scores higher, so the smallest valid padding wins for a cell
+    mp = min(max_padding, cell_width // 2)
+    if min_padding > mp or cell_width - min_padding * 2 <= 0:
+        return None
+
+    if not pixel_perfect:
+        return min_padding
+
+    for asset_width in PIXEL_PERFECT_ASSET_WIDTHS:
+        padding = (cell_width - asset_width) // 2
+        if cell_width - padding * 2 != asset_width or padding < min_padding:
+            continue
+        return padding if padding <= mp else None
+    return None
+
+
+@functools.lru_cache(maxsize=4096)
+def solve_grid_params(
+    grid_size,
+    min_padding,
+    max_padding,
+    min_line_width,
+    max_line_width,
+    min_border_width,
+    max_border_width,
+    pixel_perfect,
+    fill_board,
+):
+    # Same scoring and tie-breaking as an exhaustive scan over border, line, cell and
+    # padding widths (first best in ascending order wins), with branches pruned once
+    # their score upper bound can no longer beat the best layout found so far.
+    def cell_budget(border_width, line_width):
+        return IMG_SIZE - line_width * (grid_size - 1) - border_width * 2
+
+    def widest_asset(cell_width):
+        # Widest asset a cell could hold at minimum padding
+        asset_width = cell_width - min_padding * 2
+        if pixel_perfect and asset_width > 0:
+            return next(w for w in PIXEL_PERFECT_ASSET_WIDTHS if w <= asset_width)
+        return asset_width
+
+    def upper_bound(border_width, line_width):
+        # Best possible score with these widths: widest cell at minimum padding
+        remaining = cell_budget(border_width, line_width)
+        max_asset_width = widest_asset(remaining // grid_size)
+        if remaining <= 0 or max_asset_width <= 0:
+            return None
+        return (
+            max_asset_width * 1000
+            - (line_width - min_line_width) * 10
+            - (border_width - min_border_width) * 10
+        )
+
+    def cannot_improve(bound):
+        return bound is None or (best is not None and bound <= best_score)
+
+    best = None
+    best_score = None
+
+    for border_width in range(min_border_width, max_border_width + 1):
+        # Wider borders (and lines) only shrink the cells and add penalties
+        if cannot_improve(upper_bound(border_width, min_line_width)):
+            break
+
+        for line_width in range(min_line_width, max_line_width + 1):
+            if cannot_improve(upper_bound(border_width, line_width)):
+                break
+
+            remaining = cell_budget(border_width, line_width)
+            max_cell_width = remaining // grid_size
+            penalty = (line_width - min_line_width) * 10 + (
+                border_width - min_border_width
+            ) * 10
+
+            if fill_board:
+                if remaining % grid_size != 0:
+                    continue
+                cell_width_candidates = [max_cell_width]
+            else:
+                cell_width_candidates = range(max_cell_width, 0, -1)
+
+            local = None
+            local_score = None
+
+            for cell_width in cell_width_candidates:
+                if cell_width - min_padding * 2 <= 0:
+                    break
+                cell_bound = widest_asset(cell_width) * 1000 - penalty
+                if best is not None and cell_bound <= best_score:
+                    break
+                if local is not None and cell_bound < local_score:
+                    break
+
+                padding = smallest_padding(
+                    cell_width, min_padding, max_padding, pixel_perfect
+                )
+                if padding is None:
+                    continue
+
+                asset_width = cell_width - padding * 2
+                score = asset_width * 1000 - (padding - min_padding) * 20 - penalty
+
+                # Narrower cells come first in the exhaustive order, so they win ties
+                if local is None or score >= local_score:
+                    local_score = score
+                    local = {
+                        "cell_width": cell_width,
+                        "asset_width": asset_width,
+                        "padding": padding,
+                        "line_width": line_width,
+                        "border_width": border_width,
+                    }
+
+            if local is not None and (best is None or local_score > best_score):
+                best = local
+                best_score = local_score
+
+    return best
+
+
+# Layout used when a request sets none of the layout constraints
+DEFAULT_CONSTRAINTS = {
+    1: {
+        "min_padding": 8,
+        "min_line_width": 0,
+        "min_border_width": 8,
+        "pixel_perfect": True,
+    },
+    2: {
+        "min_padding": 3,
+        "min_line_width": 7,
+        "min_border_width": 9,
+        "pixel_perfect": True,
+    },
+    3: {
+        "min_padding": 1,
+        "min_line_width": 3,
+        "min_border_width": 3,
+        "pixel_perfect": True,
+    },
+    4: {
+        "min_padding": 1,
+        "min_line_width": 1,
+        "min_border_width": 3,
+        "pixel_perfect": True,
+    },
+    5: {
+        "min_padding": 1,
+        "min_line_width": 1,
+        "min_border_width": 3,
+        "pixel_perfect": True,
+    },
+    6: {
+        "min_padding": 1,
+        "min_line_width": 1,
+        "min_border_width": 1,
+        "pixel_perfect": True,
+    },
+    7: {
+        "min_padding": 1,
+        "min_line_width": 1,
+        "min_border_width": 1,
+        "pixel_perfect": False,
+    },
+    8: {
+        "min_padding": 1,
+        "min_line_width": 1,
+        "min_border_width": 1,
+        "pixel_perfect": False,
+    },
+    9: {
+        "min_padding": 1,
+        "min_line_width": 1,
+        "min_border_width": 1,
+        "pixel_perfect": False,
+    },
+}
+
+
+def default_grid_params(grid_size: int) -> dict[str, int]:
+    return compute_grid_params(grid_size, DEFAULT_CONSTRAINTS[grid_size])
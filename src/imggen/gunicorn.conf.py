@@ -0,0 +1,50 @@
+import os
+import tempfile
+
+# Each worker writes its metrics here so /metrics on any worker reports all of them
+os.environ.setdefault(
+    "IMGGEN_METRICS_DIR", os.path.join(tempfile.gettempdir(), "imggen-metrics")
+)
+# Sessions are snapshotted here so any worker can serve the next update
+os.environ.setdefault(
+    "IMGGEN_SESSION_DIR", os.path.join(tempfile.gettempdir(), "imggen-sessions")
+)
+
+bind = f"0.0.0.0:{os.environ.get('IMGGEN_PORT', 5000)}"
+workers = int(os.environ.get("IMGGEN_WORKERS", 2))
+
+# Every worker renders through its own pool behind a short queue: the cores are split
+# between the workers, and the queue holds two jobs per pool process
+render_processes = max(1, (os.cpu_count() or 1) // workers)
+os.environ.setdefault("IMGGEN_RENDER_PROCESSES", str(render_processes))
+os.environ.setdefault("IMGGEN_RENDER_QUEUE_SIZE", str(2 * render_processes))
+
+# More than one thread switches to the gthread worker, so requests can wait on the render
+# pool; more threads than the pool and queue hold, so overload is answered with 429
+# instead of waiting in the listen backlog
+threads = int(os.environ.get("IMGGEN_THREADS", 4 * render_processes))
+preload_app = True
+timeout = 60
+accesslog = "-"
+errorlog = "-"
+
+
+def on_starting(server):
+    import metrics
+
+    metrics.clear_snapshots()
+
+
+def post_worker_init(worker):
+    # Start the render pool in each worker after the fork from the preloaded master
+    from generator import render_engine
+
+    render_engine.start()
+
+
+def worker_exit(server, worker):
+    import metrics
+    from generator import render_engine
+
+    render_engine.shutdown()
+    metrics.write_snapshot()
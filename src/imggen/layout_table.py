@@ -0,0 +1,180 @@
+import mmap
+import os
+import struct
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# Header: magic, version, image size, grid sizes, then the covered range of each min_* key
+HEADER = struct.Struct("<8sBBBBBB")
+MAGIC = b"IMGGENLT"
+VERSION = 1
+ENTRY = struct.Struct("<BBBBB")
+ENTRY_KEYS = ("cell_width", "asset_width", "padding", "line_width", "border_width")
+
+MAX_GRID_SIZE = 9
+MIN_PADDING_RANGE = 16
+MIN_LINE_WIDTH_RANGE = 16
+MIN_BORDER_WIDTH_RANGE = 16
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "layouts.bin")
+
+
+class LayoutTable:
+    # Optimal layouts for constraints that only set min_* widths and the two flags,
+    # memory-mapped from a file written by `python layout_table.py`
+    def __init__(self, path: str, img_size: int):
+        self.path = path
+        self.img_size = img_size
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.mapped = None
+        self.dimensions = None
+        self.hits = 0
+        self.misses = 0
+
+    def load(self) -> None:
+        with self.lock:
+            if self.loaded:
+                return
+            self.loaded = True
+            try:
+                with open(self.path, "rb") as table_file:
+                    mapped = mmap.mmap(table_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (FileNotFoundError, ValueError):
+                return
+
+            magic, version, img_size, *dimensions = HEADER.unpack_from(mapped)
+            entries = dimensions[0] * dimensions[1] * dimensions[2] * dimensions[3] * 4
+            if (
+                magic != MAGIC
+                or version != VERSION
+                or img_size != self.img_size
+                or len(mapped) != HEADER.size + entries * ENTRY.size
+            ):
+                mapped.close()
+                return
+
+            self.dimensions = dimensions
+            self.mapped = mapped
+
+    def index(
+        self,
+        grid_size,
+        min_padding,
+        min_line_width,
+        min_border_width,
+        pixel_perfect,
+        fill_board,
+    ):
+        grid_sizes, paddings, line_widths, border_widths = self.dimensions
+        values = (grid_size - 1, min_padding, min_line_width, min_border_width)
+        for value, limit in zip(values, self.dimensions):
+            if (
+                not isinstance(value, int)
+                or isinstance(value, bool)
+                or not 0 <= value < limit
+            ):
+                return None
+        index = (
+            (grid_size - 1) * paddings + min_padding
+        ) * line_widths + min_line_width
+        index = index * border_widths + min_border_width
+        return index * 4 + int(pixel_perfect) * 2 + int(fill_board)
+
+    def lookup(
+        self,
+        grid_size,
+        min_padding,
+        min_line_width,
+        min_border_width,
+        pixel_perfect,
+        fill_board,
+    ):
+        # Returns (found, params); params is None when no layout satisfies the constraints
+        if not self.loaded:
+            self.load()
+
+        index = None
+        if self.mapped is not None:
+            index = self.index(
+                grid_size,
+                min_padding,
+                min_line_width,
+                min_border_width,
+                pixel_perfect,
+                fill_board,
+            )
+
+        if index is None:
+            self.misses += 1
+            return False, None
+
+        self.hits += 1
+        values = ENTRY.unpack_from(self.mapped, HEADER.size + index * ENTRY.size)
+        if values[0] == 0:
+            return True, None
+        return True, dict(zip(ENTRY_KEYS, values))
+
+    def stats(self) -> dict:
+        return {
+            "path": self.path,
+            "loaded": self.mapped is not None,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def build_grid_size(grid_size):
+    from grid_layout import IMG_SIZE, solve_grid_params
+
+    data = bytearray()
+    for min_padding in range(MIN_PADDING_RANGE):
+        for min_line_width in range(MIN_LINE_WIDTH_RANGE):
+            for min_border_width in range(MIN_BORDER_WIDTH_RANGE):
+                for pixel_perfect in (False, True):
+                    for fill_board in (False, True):
+                        # Same defaults compute_grid_params uses for missing max_* keys
+                        best = solve_grid_params(
+                            grid_size,
+                            min_padding,
+                            IMG_SIZE // 2,
+                            min_line_width,
+                            IMG_SIZE,
+                            min_border_width,
+                            IMG_SIZE,
+                            pixel_perfect,
+                            fill_board,
+                        )
+                        if best is None:
+                            data += ENTRY.pack(0, 0, 0, 0, 0)
+                        else:
+                            data += ENTRY.pack(*(best[key] for key in ENTRY_KEYS))
+    return bytes(data)
+
+
+def build(path: str) -> None:
+    from grid_layout import IMG_SIZE
+
+    with ProcessPoolExecutor() as pool:
+        chunks = list(pool.map(build_grid_size, range(1, MAX_GRID_SIZE + 1)))
+
+    header = HEADER.pack(
+        MAGIC,
+        VERSION,
+        IMG_SIZE,
+        MAX_GRID_SIZE,
+        MIN_PADDING_RANGE,
+        MIN_LINE_WIDTH_RANGE,
+        MIN_BORDER_WIDTH_RANGE,
+    )
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as table_file:
+        table_file.write(header)
+        for chunk in chunks:
+            table_file.write(chunk)
+    os.replace(temp_path, path)
+
+
+if __name__ == "__main__":
+    build(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_PATH)
@@ -0,0 +1,163 @@
+import numpy as np
+
+# Minecraft map base colors by id (Java Edition 1.17+); id 0 is transparent
+BASE_COLORS = (
+    (0, 0, 0),
+    (127, 178, 56),
+    (247, 233, 163),
+    (199, 199, 199),
+    (255, 0, 0),
+    (160, 160, 255),
+    (167, 167, 167),
+    (0, 124, 0),
+    (255, 255, 255),
+    (164, 168, 184),
+    (151, 109, 77),
+    (112, 112, 112),
+    (64, 64, 255),
+    (143, 119, 72),
+    (255, 252, 245),
+    (216, 127, 51),
+    (178, 76, 216),
+    (102, 153, 216),
+    (229, 229, 51),
+    (127, 204, 25),
+    (242, 127, 165),
+    (76, 76, 76),
+    (153, 153, 153),
+    (76, 127, 153),
+    (127, 63, 178),
+    (51, 76, 178),
+    (102, 76, 51),
+    (102, 127, 51),
+    (153, 51, 51),
+    (25, 25, 25),
+    (250, 238, 77),
+    (92, 219, 213),
+    (74, 128, 255),
+    (0, 217, 58),
+    (129, 86, 49),
+    (112, 2, 0),
+    (209, 177, 161),
+    (159, 82, 36),
+    (149, 87, 108),
+    (112, 108, 138),
+    (186, 133, 36),
+    (103, 117, 53),
+    (160, 77, 78),
+    (57, 41, 35),
+    (135, 107, 98),
+    (87, 92, 92),
+    (122, 73, 88),
+    (76, 62, 92),
+    (76, 50, 35),
+    (76, 82, 42),
+    (142, 60, 46),
+    (37, 22, 16),
+    (189, 48, 49),
+    (148, 63, 97),
+    (92, 25, 29),
+    (22, 126, 134),
+    (58, 142, 140),
+    (86, 44, 62),
+    (20, 180, 133),
+    (100, 100, 100),
+    (216, 175, 147),
+    (127, 167, 150),
+)
+
+# Each base color comes in four shades; the map byte is base_id * 4 + shade
+SHADES = (180, 220, 255, 135)
+
+MAP_SIZE = 128
+# Pixels at least this transparent become map color 0
+ALPHA_THRESHOLD = 128
+# Lookup table resolution: 6 bits per channel, 2^18 entries
+CHANNEL_BITS = 6
+
+
+def palette():
+    # RGB of every opaque map color, indexed by its map byte (ids 0-3 stay black)
+    colors = np.zeros((len(BASE_COLORS) * len(SHADES), 3), dtype=np.int32)
+    for base_id, color in enumerate(BASE_COLORS):
+        if base_id == 0:
+            continue
+        for shade, multiplier in enumerate(SHADES):
+            colors[base_id * len(SHADES) + shade] = [
+                channel * multiplier // 255 for channel in color
+            ]
+    return colors
+
+
+def build_table():
+    # Nearest map color (redmean distance) for the center of every 6-bit RGB cell.
+    # The distance is a sum of per-channel terms, so each red level adds a green and a
+    # blue term table instead of evaluating every cell against every color
+    colors = palette()[len(SHADES) :].astype(np.float32)
+    shift = 8 - CHANNEL_BITS
+    levels = (np.arange(1 << CHANNEL_BITS, dtype=np.float32) + 0.5) * (1 << shift)
+
+    green_terms = 4 * (levels[:, None] - colors[:, 1]) ** 2
+    blue_deltas = (levels[:, None] - colors[:, 2]) ** 2
+
+    table = np.empty((len(levels), len(levels), len(levels)), dtype=np.uint8)
+    for index, red in enumerate(levels):
+        mean = (red + colors[:, 0]) / 2
+        red_terms = (2 + mean / 256) * (red - colors[:, 0]) ** 2
+        blue_terms = (2 + (255 - mean) / 256) * blue_deltas
+        distance = (red_terms + green_terms)[:, None, :] + blue_terms[None, :, :]
+        table[index] = distance.argmin(axis=2) + len(SHADES)
+    return table.ravel()
+
+
+def exact_colors():
+    # Sorted 24-bit RGB of every opaque map color and its map byte (the lowest byte when
+    # two shades share an RGB value), and which table cells contain one of them
+    colors = palette()[len(SHADES) :]
+    keys = colors[:, 0] << 16 | colors[:, 1] << 8 | colors[:, 2]
+    keys, first = np.unique(keys, return_index=True)
+
+    shift = 8 - CHANNEL_BITS
+    cells = np.zeros(MAP_TABLE.size, dtype=bool)
+    cells[
+        (colors[:, 0] >> shift) << (2 * CHANNEL_BITS)
+        | (colors[:, 1] >> shift) << CHANNEL_BITS
+        | (colors[:, 2] >> shift)
+    ] = True
+    return keys.astype(np.uint32), (first + len(SHADES)).astype(np.uint8), cells
+
+
+# Built once at import, before gunicorn --preload forks the workers
+MAP_TABLE = build_table()
+EXACT_KEYS, EXACT_COLORS, EXACT_CELLS = exact_colors()
+
+
+def to_map_colors(image) -> bytes:
+    # Map bytes of a 128x128 RGBA image, row by row as a map item stores them
+    pixels = np.asarray(image)
+    if pixels.shape[:2] != (MAP_SIZE, MAP_SIZE):
+        msg = f"Map colors need a {MAP_SIZE}x{MAP_SIZE} image, got {pixels.shape[1]}x{pixels.shape[0]}."
+        raise ValueError(msg)
+
+    shift = 8 - CHANNEL_BITS
+    channels = pixels[..., :3].astype(np.uint32) >> shift
+    indexes = (
+        channels[..., 0] << (2 * CHANNEL_BITS)
+        | channels[..., 1] << CHANNEL_BITS
+        | channels[..., 2]
+    )
+    colors = MAP_TABLE[indexes]
+
+    # The table answers for the center of a 6-bit cell, which can miss a palette color
+    # sitting near a cell edge; pixels that are exactly a map color always get it. Only
+    # the few cells holding a palette color need the full RGB compared
+    candidates = np.flatnonzero(EXACT_CELLS[indexes])
+    if candidates.size:
+        rgb = pixels[..., :3].reshape(-1, 3)[candidates].astype(np.uint32)
+        keys = rgb[:, 0] << 16 | rgb[:, 1] << 8 | rgb[:, 2]
+        positions = np.minimum(np.searchsorted(EXACT_KEYS, keys), len(EXACT_KEYS) - 1)
+        exact = EXACT_KEYS[positions] == keys
+        colors.reshape(-1)[candidates[exact]] = EXACT_COLORS[positions[exact]]
+
+    colors[pixels[..., 3] < ALPHA_THRESHOLD] = 0
+    return colors.tobytes()
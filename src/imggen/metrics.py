@@ -0,0 +1,370 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from config import env_int
+
+log = logging.getLogger("imggen")
+
+# Histogram upper bounds in seconds: stages take microseconds to milliseconds,
+# requests can wait on the render queue for seconds
+BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+METRICS = {
+    "imggen_requests_total": ("counter", "Requests by route and response status."),
+    "imggen_errors_total": ("counter", "Errors by route and imggen error kind."),
+    "imggen_request_duration_seconds": ("histogram", "Request duration by route."),
+    "imggen_render_queue_depth": (
+        "gauge",
+        "Render jobs waiting for a pool process, summed over the server processes.",
+    ),
+    "imggen_render_in_flight": (
+        "gauge",
+        "Render jobs running, summed over the server processes.",
+    ),
+    "imggen_render_capacity": (
+        "gauge",
+        "Render jobs accepted before requests are rejected with 429, summed over the server processes.",
+    ),
+    "imggen_stage_duration_seconds": (
+        "histogram",
+        "Time spent per pipeline stage, summed over one request.",
+    ),
+}
+
+# Requests slower than this log their stage breakdown (0 disables the log)
+SLOW_REQUEST_MS = env_int("IMGGEN_SLOW_REQUEST_MS", 0)
+
+# With several server processes each one writes its counters here, and /metrics sums them
+METRICS_DIR = os.environ.get("IMGGEN_METRICS_DIR") or None
+SNAPSHOT_INTERVAL = 1.0
+
+# Error messages raised by parsing and validation, mapped to a stable error kind
+ERROR_KINDS = (
+    ("Invalid grid size", "invalid_grid_size"),
+    ("Invalid colors", "invalid_color"),
+    ("Invalid texture", "invalid_texture"),
+    ("Invalid team key", "invalid_team"),
+    ("Constraints:", "invalid_constraints"),
+    ("No valid grid configuration", "no_layout"),
+    ("Invalid response mode", "invalid_option"),
+    ("Invalid output profile", "invalid_option"),
+    ("Invalid timelapse format", "invalid_option"),
+    ("must be a boolean, got", "invalid_option"),
+    ("requires the image to be persisted", "invalid_option"),
+    ("Invalid JSON body", "bad_request"),
+)
+
+
+def error_kind(error) -> str:
+    # Matched by class name so this module needs no server or engine imports
+    name = type(error).__name__
+    if name == "QueueFullError":
+        return "queue_full"
+    if name == "SessionNotFoundError":
+        return "session_not_found"
+    if name == "TimelapseTooLongError":
+        return "timelapse_too_long"
+    if isinstance(error, TimeoutError):
+        return "timeout"
+    if isinstance(error, KeyError):
+        # A field missing from the payload; unknown teams raise "Invalid team key"
+        return "bad_request"
+    message = str(error)
+    for prefix, kind in ERROR_KINDS:
+        if prefix in message:
+            return kind
+    if isinstance(error, ValueError):
+        return "invalid_request"
+    if isinstance(error, (TypeError, AttributeError)) or name == "BadRequest":
+        return "bad_request"
+    return "internal"
+
+
+class RequestTimings:
+    # Stage durations of one request; render jobs and batch threads add to it too
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.errors = []
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def merge(self, stages):
+        for name, seconds in stages.items():
+            self.add(name, seconds)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return dict(self.stages)
+
+
+current_timings = contextvars.ContextVar("imggen_timings", default=None)
+
+
+@contextmanager
+def stage(name):
+    timings = current_timings.get()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - started)
+
+
+def label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        # Callables returning [(name, labels, value)], read whenever a snapshot is taken
+        self.gauge_sources = []
+
+    def register_gauges(self, source) -> None:
+        self.gauge_sources.append(source)
+
+    def inc(self, name, labels, amount=1):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+            for index, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[0][index] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def snapshot(self) -> dict:
+        gauges = [
+            [name, labels, value]
+            for source in self.gauge_sources
+            for name, labels, value in source()
+        ]
+        with self.lock:
+            return {
+                "gauges": gauges,
+                "counters": [
+                    [name, dict(labels), value]
+                    for (name, labels), value in self.counters.items()
+                ],
+                "histograms": [
+                    [name, dict(labels), list(histogram[0]), histogram[1], histogram[2]]
+                    for (name, labels), histogram in self.histograms.items()
+                ],
+            }
+
+
+registry = Registry()
+snapshot_lock = threading.Lock()
+last_snapshot = 0.0
+flush_timer = None
+
+
+def start_request() -> RequestTimings:
+    timings = RequestTimings()
+    current_timings.set(timings)
+    return timings
+
+
+def record_error(error) -> None:
+    timings = current_timings.get()
+    if timings is not None:
+        timings.errors.append(error_kind(error))
+
+
+def finish_request(route, status) -> None:
+    timings = current_timings.get()
+    if timings is None:
+        return
+    current_timings.set(None)
+
+    elapsed = time.perf_counter() - timings.started
+    stages = timings.snapshot()
+
+    registry.inc("imggen_requests_total", {"route": route, "status": str(status)})
+    for kind in timings.errors:
+        registry.inc("imggen_errors_total", {"route": route, "kind": kind})
+    registry.observe("imggen_request_duration_seconds", {"route": route}, elapsed)
+    for name, seconds in stages.items():
+        registry.observe("imggen_stage_duration_seconds", {"stage": name}, seconds)
+
+    if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+        breakdown = {name: round(seconds * 1000, 3) for name, seconds in stages.items()}
+        log.warning(
+            "Slow request %s (%s): %.1f ms, stages (ms): %s",
+            route,
+            status,
+            elapsed * 1000,
+            json.dumps(breakdown, sort_keys=True),
+        )
+
+    maybe_write_snapshot()
+
+
+def snapshot_path(pid) -> str:
+    return os.path.join(METRICS_DIR, f"{pid}.json")
+
+
+def write_snapshot() -> None:
+    if METRICS_DIR is None:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = snapshot_path(os.getpid())
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as snapshot_file:
+        json.dump(registry.snapshot(), snapshot_file)
+    os.replace(temp_path, path)
+
+
+def flush_snapshot() -> None:
+    global last_snapshot, flush_timer
+    with snapshot_lock:
+        flush_timer = None
+        last_snapshot = time.monotonic()
+    try:
+        write_snapshot()
+    except OSError as e:
+        log.warning("Could not write metrics snapshot: %s", e)
+
+
+def maybe_write_snapshot() -> None:
+    # At most one write per interval; changes in between are flushed by a timer, so a
+    # worker that goes idle still publishes its last requests
+    global flush_timer
+    if METRICS_DIR is None:
+        return
+    with snapshot_lock:
+        if flush_timer is not None:
+            return
+        delay = SNAPSHOT_INTERVAL - (time.monotonic() - last_snapshot)
+        if delay > 0:
+            flush_timer = threading.Timer(delay, flush_snapshot)
+            flush_timer.daemon = True
+            flush_timer.start()
+            return
+    flush_snapshot()
+
+
+def clear_snapshots() -> None:
+    # Called by the server master before workers start, so old pids are not summed
+    if METRICS_DIR is None or not os.path.isdir(METRICS_DIR):
+        return
+    for name in os.listdir(METRICS_DIR):
+        if name.endswith(".json"):
+            os.remove(os.path.join(METRICS_DIR, name))
+
+
+def collect() -> list:
+    # Own snapshot first, then every other process that wrote one
+    if METRICS_DIR is None:
+        return [registry.snapshot()]
+
+    write_snapshot()
+    snapshots = []
+    for name in sorted(os.listdir(METRICS_DIR)):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name)) as snapshot_file:
+                snapshots.append(json.load(snapshot_file))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: dict, extra=None) -> str:
+    items = sorted(labels.items())
+    if extra:
+        items.append(extra)
+    if not items:
+        return ""
+    return (
+        "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in items) + "}"
+    )
+
+
+def render_metrics() -> str:
+    counters = {}
+    gauges = {}
+    histograms = {}
+    for snapshot in collect():
+        for name, labels, value in snapshot["counters"]:
+            key = (name, label_key(labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, value in snapshot.get("gauges", []):
+            key = (name, label_key(labels))
+            gauges[key] = gauges.get(key, 0) + value
+        for name, labels, buckets, total, count in snapshot["histograms"]:
+            key = (name, label_key(labels))
+            merged = histograms.setdefault(key, [[0] * len(BUCKETS), 0.0, 0])
+            merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+            merged[1] += total
+            merged[2] += count
+
+    lines = []
+    for metric, (kind, help_text) in METRICS.items():
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} {kind}")
+        if kind in ("counter", "gauge"):
+            values = counters if kind == "counter" else gauges
+            for (name, labels), value in sorted(values.items()):
+                if name == metric:
+                    lines.append(f"{metric}{format_labels(dict(labels))} {value}")
+            continue
+
+        for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+            if name != metric:
+                continue
+            labels = dict(labels)
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, buckets):
+                cumulative += bucket
+                le = format_labels(labels, ("le", repr(bound)))
+                lines.append(f"{metric}_bucket{le} {cumulative}")
+            le = format_labels(labels, ("le", "+Inf"))
+            lines.append(f"{metric}_bucket{le} {count}")
+            lines.append(f"{metric}_sum{format_labels(labels)} {total}")
+            lines.append(f"{metric}_count{format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
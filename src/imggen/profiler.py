@@ -0,0 +1,277 @@
+import contextvars
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from config import env_float, env_int
+
+log = logging.getLogger("imggen")
+
+# Fraction of requests whose stacks are sampled (0 disables profiling)
+PROFILE_RATE = env_float("IMGGEN_PROFILE_RATE", 0.0)
+PROFILE_INTERVAL = env_int("IMGGEN_PROFILE_INTERVAL_MS", 1) / 1000
+PROFILE_DIR = os.environ.get("IMGGEN_PROFILE_DIR") or os.path.join(
+    tempfile.gettempdir(), "imggen-profiles"
+)
+# Each process appends to its own file, rotated at this size with this many backups
+PROFILE_MAX_BYTES = env_int("IMGGEN_PROFILE_MAX_BYTES", 8 * 1024 * 1024)
+PROFILE_BACKUPS = env_int("IMGGEN_PROFILE_BACKUPS", 2)
+# Files of exited processes (worker restarts, rebuilt render pools) are never rotated
+# again, so the directory as a whole is trimmed to this size, oldest files first
+PROFILE_MAX_TOTAL_BYTES = env_int("IMGGEN_PROFILE_MAX_TOTAL_BYTES", 64 * 1024 * 1024)
+MAX_STACK_DEPTH = 128
+
+# Rate set through the admin endpoint, shared by every server process
+RATE_FILE = "rate"
+RATE_CHECK_INTERVAL = 1.0
+
+profiled = contextvars.ContextVar("imggen_profiled", default=False)
+
+
+def validate_rate(rate) -> float:
+    if isinstance(rate, bool) or not isinstance(rate, (int, float)):
+        msg = f"Profile rate must be a number, got {type(rate).__name__}"
+        raise ValueError(msg)
+    if not 0 <= rate <= 1:
+        msg = f"Profile rate must be between 0 and 1, got {rate}"
+        raise ValueError(msg)
+    return float(rate)
+
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def collapse(frame) -> str:
+    # Root first, frames joined by ';' as flamegraph.pl and speedscope expect
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Sampler:
+    # One thread per process samples every registered thread at a fixed interval;
+    # it only wakes while at least one sampled request is running
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.active = {}
+        self.thread = None
+
+    def start(self, ident) -> bool:
+        with self.lock:
+            if ident in self.active:
+                return False
+            self.active[ident] = {}
+            # Started lazily so it never exists in a process before a fork
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self.run, name="imggen-profiler", daemon=True
+                )
+                self.thread.start()
+        self.wake.set()
+        return True
+
+    def stop(self, ident) -> dict:
+        with self.lock:
+            stacks = self.active.pop(ident, {})
+            if not self.active:
+                self.wake.clear()
+        return stacks
+
+    def run(self) -> None:
+        while True:
+            self.wake.wait()
+            frames = sys._current_frames()
+            with self.lock:
+                for ident, stacks in self.active.items():
+                    frame = frames.get(ident)
+                    if frame is None:
+                        continue
+                    stack = collapse(frame)
+                    stacks[stack] = stacks.get(stack, 0) + 1
+            del frames
+            time.sleep(self.interval)
+
+
+class StackWriter:
+    def __init__(self, directory, max_bytes, backups, max_total_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.max_total_bytes = max_total_bytes
+        self.lock = threading.Lock()
+        self.pruned_pid = None
+
+    def path(self) -> str:
+        return os.path.join(self.directory, f"stacks-{os.getpid()}.collapsed")
+
+    def rotate(self, path) -> None:
+        for index in range(self.backups, 0, -1):
+            source = path if index == 1 else f"{path}.{index - 1}"
+            if os.path.exists(source):
+                os.replace(source, f"{path}.{index}")
+        if os.path.exists(path):
+            os.remove(path)
+
+    def stack_files(self):
+        # (mtime, size, path) of every stack file in the directory, rotated ones included
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if ".collapsed" not in entry.name:
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files
+
+    def prune(self) -> None:
+        # Oldest first until the directory fits; this process's current file is kept
+        if not self.max_total_bytes:
+            return
+        files = self.stack_files()
+        total = sum(size for _, size, _ in files)
+        current = self.path()
+        for _, size, path in sorted(files):
+            if total <= self.max_total_bytes:
+                break
+            if path == current:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def write(self, stacks: dict) -> None:
+        if not stacks:
+            return
+        data = "".join(f"{stack} {count}\n" for stack, count in stacks.items())
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self.path()
+            try:
+                size = os.path.getsize(path)
+            except FileNotFoundError:
+                size = 0
+            rotated = self.max_bytes and size + len(data) > self.max_bytes
+            if rotated:
+                self.rotate(path)
+            with open(path, "a") as stacks_file:
+                stacks_file.write(data)
+
+            # Only a new process or a rotation can grow the directory past its budget
+            if rotated or self.pruned_pid != os.getpid():
+                self.pruned_pid = os.getpid()
+                self.prune()
+
+
+sampler = Sampler(PROFILE_INTERVAL)
+writer = StackWriter(
+    PROFILE_DIR, PROFILE_MAX_BYTES, PROFILE_BACKUPS, PROFILE_MAX_TOTAL_BYTES
+)
+
+rate_lock = threading.Lock()
+current_rate = PROFILE_RATE
+rate_checked = 0.0
+rate_mtime = None
+
+
+def get_rate() -> float:
+    # The rate file overrides IMGGEN_PROFILE_RATE once an admin has set it
+    global current_rate, rate_checked, rate_mtime
+    now = time.monotonic()
+    if now - rate_checked < RATE_CHECK_INTERVAL:
+        return current_rate
+    with rate_lock:
+        rate_checked = now
+        path = os.path.join(PROFILE_DIR, RATE_FILE)
+        try:
+            mtime = os.stat(path).st_mtime
+            if mtime != rate_mtime:
+                with open(path) as rate_file:
+                    current_rate = validate_rate(float(rate_file.read().strip()))
+                rate_mtime = mtime
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            log.warning("Ignoring profile rate file: %s", e)
+    return current_rate
+
+
+def set_rate(rate) -> float:
+    global current_rate, rate_checked
+    rate = validate_rate(rate)
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, RATE_FILE)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as rate_file:
+        rate_file.write(repr(rate))
+    os.replace(temp_path, path)
+    with rate_lock:
+        current_rate = rate
+        rate_checked = 0.0
+    return rate
+
+
+def start_request(sample_thread=True) -> bool:
+    # The decision is made once per request; render jobs inherit it from the context.
+    # An event loop thread serves many requests, so async servers only sample the jobs
+    rate = get_rate()
+    sampled = rate > 0 and random.random() < rate
+    profiled.set(sampled)
+    if sampled and sample_thread:
+        sampler.start(threading.get_ident())
+    return sampled
+
+
+def finish_request() -> None:
+    if not profiled.get():
+        return
+    profiled.set(False)
+    save(sampler.stop(threading.get_ident()))
+
+
+def save(stacks) -> None:
+    try:
+        writer.write(stacks)
+    except OSError as e:
+        log.warning("Could not write profile stacks: %s", e)
+
+
+def call(fn, *args):
+    # Samples fn on the current thread, unless the thread is already being sampled
+    ident = threading.get_ident()
+    if not sampler.start(ident):
+        return fn(*args)
+    try:
+        return fn(*args)
+    finally:
+        save(sampler.stop(ident))
+
+
+def stats() -> dict:
+    files = []
+    if os.path.isdir(PROFILE_DIR):
+        files = writer.stack_files()
+    return {
+        "rate": get_rate(),
+        "interval_ms": PROFILE_INTERVAL * 1000,
+        "directory": PROFILE_DIR,
+        "max_bytes": PROFILE_MAX_BYTES,
+        "backups": PROFILE_BACKUPS,
+        "max_total_bytes": PROFILE_MAX_TOTAL_BYTES,
+        "total_bytes": sum(size for _, size, _ in files),
+        "files": sorted(os.path.basename(path) for _, _, path in files),
+    }
@@ -0,0 +1,166 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import profiler
+from metrics import RequestTimings, current_timings
+
+
+class QueueFullError(Exception):
+    pass
+
+
+def run_job(fn, args, stats_fn, sampled=False):
+    # Runs inside a pool process; the stats snapshot lets the parent report child caches,
+    # and the stage timings are added to the request that submitted the job
+    timings = RequestTimings()
+    token = current_timings.set(timings)
+    try:
+        # Profiled requests are sampled here too, into this process's stack file
+        result = profiler.call(fn, *args) if sampled else fn(*args)
+    finally:
+        current_timings.reset(token)
+    return os.getpid(), result, stats_fn() if stats_fn else None, timings.snapshot()
+
+
+def warm_up(_):
+    return os.getpid()
+
+
+class RenderEngine:
+    # Bounded render queue served by a pool of worker processes, or inline when processes is 0
+    def __init__(self, processes: int, queue_size: int, preload=(), stats_fn=None):
+        self.processes = processes
+        self.queue_size = queue_size
+        self.capacity = max(processes, 1) + queue_size
+        self.preload = list(preload)
+        self.stats_fn = stats_fn
+        self.slots = threading.BoundedSemaphore(self.capacity)
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pending = 0
+        self.max_pending = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.worker_stats = {}
+
+    def start(self) -> None:
+        if self.processes == 0:
+            return
+        with self.lock:
+            if self.executor is not None:
+                return
+            # forkserver children start from a clean single-threaded parent with the
+            # renderer preloaded, so forking never copies locks held by request threads
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(self.preload)
+            self.executor = ProcessPoolExecutor(self.processes, mp_context=context)
+            executor = self.executor
+
+        # Spawn every process up front instead of on the first requests
+        list(executor.map(warm_up, range(self.processes)))
+
+    def shutdown(self) -> None:
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def submit(self, fn, *args, block=False, timeout=None) -> Future:
+        if block:
+            acquired = self.slots.acquire(timeout=timeout)
+        else:
+            acquired = self.slots.acquire(blocking=False)
+
+        if not acquired:
+            with self.lock:
+                self.rejected += 1
+            msg = "Render queue is full, retry later."
+            raise QueueFullError(msg)
+
+        with self.lock:
+            self.pending += 1
+            self.submitted += 1
+            self.max_pending = max(self.max_pending, self.pending)
+
+        sampled = profiler.profiled.get()
+        try:
+            if self.processes == 0:
+                future = Future()
+                try:
+                    # Stage timings go straight to the caller's request
+                    result = profiler.call(fn, *args) if sampled else fn(*args)
+                    future.set_result((None, result, None, None))
+                except Exception as e:
+                    future.set_exception(e)
+            else:
+                self.start()
+                future = self.executor.submit(run_job, fn, args, self.stats_fn, sampled)
+        except BaseException as e:
+            if isinstance(e, BrokenProcessPool):
+                with self.lock:
+                    self.executor = None
+            self.release(failed=True)
+            raise
+
+        future.add_done_callback(self.on_done)
+        return future
+
+    def on_done(self, future: Future) -> None:
+        error = future.exception() if not future.cancelled() else None
+        if isinstance(error, BrokenProcessPool):
+            # A crashed worker breaks the whole pool; the next submit starts a new one
+            with self.lock:
+                self.executor = None
+        self.release(failed=future.cancelled() or error is not None)
+
+    def release(self, failed: bool) -> None:
+        with self.lock:
+            self.pending -= 1
+            if failed:
+                self.failed += 1
+            else:
+                self.completed += 1
+        self.slots.release()
+
+    def result(self, future: Future, timeout=None):
+        pid, result, worker_stats, stages = future.result(timeout=timeout)
+        if worker_stats is not None:
+            with self.lock:
+                self.worker_stats[pid] = worker_stats
+        timings = current_timings.get()
+        if stages and timings is not None:
+            timings.merge(stages)
+        return result
+
+    def run(self, fn, *args, block=False, timeout=None):
+        return self.result(
+            self.submit(fn, *args, block=block, timeout=timeout), timeout
+        )
+
+    def gauges(self) -> list:
+        with self.lock:
+            in_flight = min(self.pending, max(self.processes, 1))
+            return [
+                ["imggen_render_queue_depth", {}, self.pending - in_flight],
+                ["imggen_render_in_flight", {}, in_flight],
+                ["imggen_render_capacity", {}, self.capacity],
+            ]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "processes": self.processes,
+                "capacity": self.capacity,
+                "queue_depth": self.pending,
+                "queued": max(0, self.pending - max(self.processes, 1)),
+                "max_queue_depth": self.max_pending,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+            }
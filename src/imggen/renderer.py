@@ -0,0 +1,759 @@
+import json
+import os
+
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw
+
+from atlas import DEFAULT_PATH as ATLAS_PATH
+from bingo import evaluate
+from cache import LRUCache
+from compositor import (
+    blit_tiles,
+    cell_tile,
+    fill_rect,
+    new_canvas,
+    outline_rect,
+    rgba,
+    sprite_layers,
+)
+from config import env_float, env_int
+from encoding import PROFILES, encode, validate_profile
+from grid_layout import IMG_SIZE, compute_grid_params, default_grid_params, layout_table
+from mapcolors import to_map_colors
+from metrics import stage
+from shared_cache import open_shared_cache
+from storage import OutputStore, content_key
+from texture_store import TextureStore
+
+OUTPUT_DIR = os.environ.get("IMGGEN_OUTPUT_DIR") or "/app/public"
+TEXTURES_DIR = os.environ.get("IMGGEN_TEXTURES_DIR") or "/app/textures"
+os.makedirs(OUTPUT_DIR, exist_ok=True)
+OUTPUT_PROFILE = validate_profile(os.environ.get("IMGGEN_OUTPUT_PROFILE") or "png")
+
+# Part of every output file key: bump it whenever a drawing or encoding change alters
+# the pixels or bytes produced for the same board, so stored outputs are not reused
+RENDER_VERSION = 1
+
+DEFAULT_TEAM_NAMES = ["team1", "team2", "team3", "team4"]
+DEFAULT_TEAM_COLORS = [
+    "#64FF64",
+    "#64FFFF",
+    "#FFFF64",
+    "#FF6464",
+]
+
+# Decoded once at import, before gunicorn --preload forks the workers; from the packed
+# atlas when one was built for TEXTURES_DIR, otherwise from the loose PNGs
+texture_store = TextureStore(
+    TEXTURES_DIR, os.environ.get("IMGGEN_TEXTURE_ATLAS") or ATLAS_PATH
+)
+texture_store.load()
+
+# Sprites scaled to an asset width and split into blend layers, keyed by (sprite, asset_width)
+scaled_texture_cache = LRUCache(env_int("IMGGEN_SPRITE_CACHE_SIZE", 4096))
+
+
+def get_sprite_layers(texture_name, asset_width):
+    key = (texture_store.normalize(texture_name), asset_width)
+    layers = scaled_texture_cache.get(key)
+    if layers is not None:
+        return layers
+
+    texture_image = texture_store.get(texture_name)
+    if texture_image is None:
+        return None
+
+    # Might stretch texture, but ensures good styling
+    scaled_image = texture_image.resize(
+        (asset_width, asset_width), resample=Image.Resampling.NEAREST
+    )
+    layers = sprite_layers(scaled_image)
+    scaled_texture_cache.put(key, layers)
+    return layers
+
+
+def detect_bingo(grid_size, items, draw, grid_params, team_info):
+    # Completed lines and near misses for every team, with the winner's line drawn
+    report = evaluate(grid_size, items, team_info)
+    if report["winning_line"] is None:
+        return report
+
+    line, cells = report["winning_line"]
+    # A single cell board has no row to draw across
+    if line["type"] == "row" and grid_size == 1:
+        return report
+
+    start_x, start_y = cell_position(grid_params, *cells[0])
+    end_x, end_y = cell_position(grid_params, *cells[-1])
+    draw_bingo_line(
+        draw,
+        int(start_x),
+        int(start_y),
+        int(end_x),
+        int(end_y),
+        grid_params["cell_width"],
+        team_info[report["winner"]]["color"],
+        grid_params["padding"],
+    )
+    return report
+
+
+def draw_bingo_line(
+    draw, start_cell_x, start_cell_y, end_cell_x, end_cell_y, cell_width, color, padding
+):
+    # Detection only, nothing to draw on
+    if draw is None:
+        return
+
+    cx1 = start_cell_x + cell_width // 2
+    cy1 = start_cell_y + cell_width // 2
+    cx2 = end_cell_x + cell_width // 2
+    cy2 = end_cell_y + cell_width // 2
+
+    # main line
+    draw.line(
+        [(cx1, cy1), (cx2, cy2)],
+        fill=color,
+        width=padding,
+    )
+
+    # round caps
+    r = padding // 2
+
+    draw.ellipse(
+        [cx1 - r, cy1 - r, cx1 + r, cy1 + r],
+        fill=color,
+    )
+    draw.ellipse(
+        [cx2 - r, cy2 - r, cx2 + r, cy2 + r],
+        fill=color,
+    )
+
+
+# Content-addressed output files, garbage collected by age and total size
+output_store = OutputStore(
+    OUTPUT_DIR,
+    max_age=env_int("IMGGEN_OUTPUT_MAX_AGE", 24 * 60 * 60),
+    max_bytes=env_int("IMGGEN_OUTPUT_MAX_BYTES", 1024 * 1024 * 1024),
+    gc_interval=env_int("IMGGEN_OUTPUT_GC_INTERVAL", 5 * 60),
+)
+
+# Encoded outputs shared with other replicas, so a board is rendered once across them;
+# lookups and writes are skipped while the backend is failing
+shared_cache = open_shared_cache(
+    os.environ.get("IMGGEN_SHARED_CACHE"),
+    ttl=env_int("IMGGEN_SHARED_CACHE_TTL", 24 * 60 * 60),
+    max_bytes=env_int("IMGGEN_SHARED_CACHE_MAX_BYTES", 1024 * 1024 * 1024),
+    max_entry_bytes=env_int("IMGGEN_SHARED_CACHE_MAX_ENTRY_BYTES", 1024 * 1024),
+    timeout=env_float("IMGGEN_SHARED_CACHE_TIMEOUT", 0.25),
+    retry_after=env_float("IMGGEN_SHARED_CACHE_RETRY_AFTER", 30.0),
+    gc_interval=env_int("IMGGEN_SHARED_CACHE_GC_INTERVAL", 5 * 60),
+)
+
+# Background, grid lines and border placed on the outer canvas, keyed by layout and colors
+skeleton_cache = LRUCache(env_int("IMGGEN_SKELETON_CACHE_SIZE", 64))
+
+# Skeletons with sprites pasted, keyed by a hash of layout, colors and items
+base_board_cache = LRUCache(env_int("IMGGEN_BASE_CACHE_SIZE", 256))
+
+# Fully rendered cells, keyed by sprites, cell geometry, background and completion marks
+tile_cache = LRUCache(env_int("IMGGEN_TILE_CACHE_SIZE", 2048))
+
+
+def is_valid_color(color, memo):
+    valid = memo.get(color)
+    if valid is None:
+        try:
+            with stage("colors"):
+                ImageColor.getrgb(color)
+            valid = True
+        except (ValueError, TypeError):
+            valid = False
+        memo[color] = valid
+    return valid
+
+
+def parse_board(data, memo=None):
+    # memo is shared across the boards of a batch to skip repeated color and layout work
+    if memo is None:
+        memo = {}
+    color_memo = memo.setdefault("colors", {})
+    grid_params_memo = memo.setdefault("grid_params", {})
+
+    settings = data.get("settings", {})
+    items = data.get("items", [])
+
+    if not settings and not items:
+        settings = data.get("map_raw", {}).get("settings", {})
+        items = data.get("map_raw", {}).get("items", [])
+
+    grid_size = settings.get("grid_size", 5)
+    teams = settings.get("teams", [])
+    constraints = settings.get("constraints", {})
+
+    if grid_size < 1 or grid_size > 9:
+        msg = "Invalid grid size entered (grid_size in 'settings' section)."
+        raise ValueError(msg)
+
+    team_info = {}
+    invalid_colors = []
+
+    for i, team in enumerate(teams):
+        team_name = team.get("name", DEFAULT_TEAM_NAMES[i])
+        team_placement = team.get("placement", None)
+        team_color = str(team.get("color") or DEFAULT_TEAM_COLORS[i])
+        if not is_valid_color(team_color, color_memo):
+            invalid_colors.append(team_color)
+
+        team_info[team_name] = {
+            "name": team_name,
+            "placement": team_placement,
+            "color": team_color,
+        }
+
+    # Colors
+    custom_colors = settings.get("colors", {})
+    bg_color = str(
+        custom_colors.get("bg_color", None)
+        or custom_colors.get("background_color", None)
+        or "#D6BE96"
+    )  # Light Beige
+    outer_bg_color = str(
+        custom_colors.get("outer_bg_color", None)
+        or custom_colors.get("outer_background_color", None)
+        or bg_color
+        or "#D6BE96"
+    )  # Light Beige
+    fg_color = str(
+        custom_colors.get("fg_color", None)
+        or custom_colors.get("foreground_color", None)
+        or "#99876C"
+    )  # Dark Beige
+    line_color = str(custom_colors.get("line_color", None) or fg_color)
+    border_color = str(custom_colors.get("border_color", None) or fg_color)
+
+    colors = [bg_color, fg_color, line_color, border_color]
+
+    for color in colors:
+        if not is_valid_color(color, color_memo):
+            invalid_colors.append(color)
+
+    if invalid_colors:
+        msg = f"Invalid colors provided: {', '.join(invalid_colors)}"
+        raise ValueError(msg)
+
+    # Dimensions
+    recompute_keys = {
+        "min_padding",
+        "max_padding",
+        "min_line_width",
+        "max_line_width",
+        "min_border_width",
+        "max_border_width",
+        "pixel_perfect",
+        "fill_board",
+    }
+
+    should_recompute = constraints and any(key in constraints for key in recompute_keys)
+
+    with stage("grid_params"):
+        if should_recompute:
+            memo_key = (grid_size, json.dumps(constraints, sort_keys=True, default=str))
+            grid_params = grid_params_memo.get(memo_key)
+            if grid_params is None:
+                grid_params = compute_grid_params(
+                    grid_size=grid_size,
+                    constraints=constraints,
+                )
+                grid_params_memo[memo_key] = grid_params
+        else:
+            grid_params = default_grid_params(grid_size)
+
+    return {
+        "grid_size": grid_size,
+        "items": items,
+        "team_info": team_info,
+        "grid_params": grid_params,
+        "bg_color": bg_color,
+        "outer_bg_color": outer_bg_color,
+        "line_color": line_color,
+        "border_color": border_color,
+        "center_board": constraints.get("center_board", True),
+    }
+
+
+def board_items(board):
+    # Items that fall inside the grid, in request order
+    grid_size = board["grid_size"]
+    for item in board["items"]:
+        if item["row"] + 1 > grid_size or item["column"] + 1 > grid_size:
+            continue
+        yield item
+
+
+def completed_teams_of(item):
+    if "completed" not in item:
+        return []
+    return [team for team, value in item.get("completed", {}).items() if value]
+
+
+def cell_position(grid_params, row, column):
+    cell_x = grid_params["border_width"] + column * (
+        grid_params["cell_width"] + grid_params["line_width"]
+    )
+    cell_y = grid_params["border_width"] + row * (
+        grid_params["cell_width"] + grid_params["line_width"]
+    )
+    return cell_x, cell_y
+
+
+def board_width(grid_size, grid_params):
+    return (
+        grid_params["cell_width"] * grid_size
+        + grid_params["line_width"] * (grid_size - 1)
+        + grid_params["border_width"] * 2
+    )
+
+
+def validate_items(board):
+    team_info = board["team_info"]
+
+    for item in board_items(board):
+        texture_name = item["sprite"]
+
+        # Check if texture exists
+        if texture_name not in texture_store:
+            msg = f"Invalid texture {texture_name} provided."
+            raise ValueError(msg)
+
+        for completed_team in completed_teams_of(item):
+            team = team_info.get(completed_team)
+
+            if team is None or not team["color"] or not team["placement"]:
+                msg = f"Invalid team key entered ({completed_team} in 'completed' section of '{texture_name}' [row {item['row']}, column {item['column']}])."
+                raise ValueError(msg)
+
+
+def base_board_key(board):
+    key = {
+        "grid_size": board["grid_size"],
+        "grid_params": board["grid_params"],
+        "colors": [
+            board["bg_color"],
+            board["outer_bg_color"],
+            board["line_color"],
+            board["border_color"],
+        ],
+        "centered": is_centered(board),
+        "items": [
+            [item["row"], item["column"], item["sprite"]] for item in board_items(board)
+        ],
+    }
+    return content_key(key)
+
+
+def output_key(board, profile):
+    # Everything that affects the rendered pixels, their encoding or the bingo result,
+    # including the renderer, the encoder and the textures themselves
+    key = {
+        "render_version": RENDER_VERSION,
+        "pillow": Image.__version__,
+        "textures": texture_store.content_hash,
+        "profile": profile,
+        "grid_size": board["grid_size"],
+        "grid_params": board["grid_params"],
+        "colors": [
+            board["bg_color"],
+            board["outer_bg_color"],
+            board["line_color"],
+            board["border_color"],
+        ],
+        "center_board": board["center_board"],
+        "teams": [
+            [team["name"], team["placement"], team["color"]]
+            for team in board["team_info"].values()
+        ],
+        "items": [
+            [item["row"], item["column"], item["sprite"], completed_teams_of(item)]
+            for item in board_items(board)
+        ],
+    }
+    return content_key(key)
+
+
+def is_centered(board):
+    used_width = board_width(board["grid_size"], board["grid_params"])
+    return bool(board["center_board"]) and used_width != IMG_SIZE
+
+
+def board_region(canvas, board):
+    # View of the canvas the board itself covers, shifted to the center if requested
+    used_width = board_width(board["grid_size"], board["grid_params"])
+    offset = (IMG_SIZE - used_width) // 2 if is_centered(board) else 0
+    return canvas[offset : offset + used_width, offset : offset + used_width]
+
+
+def skeleton_key(board):
+    key = {
+        "grid_size": board["grid_size"],
+        "grid_params": board["grid_params"],
+        "colors": [
+            board["bg_color"],
+            board["outer_bg_color"],
+            board["line_color"],
+            board["border_color"],
+        ],
+        "centered": is_centered(board),
+    }
+    return content_key(key)
+
+
+def render_skeleton(board):
+    grid_size = board["grid_size"]
+    grid_params = board["grid_params"]
+    line_color = board["line_color"]
+    line_width = grid_params["line_width"]
+    border_width = grid_params["border_width"]
+
+    # Create the base image, with the board already placed on the outer canvas
+    if is_centered(board):
+        canvas = new_canvas(IMG_SIZE, board["outer_bg_color"])
+        region = board_region(canvas, board)
+        region[...] = rgba(board["bg_color"])
+    else:
+        canvas = new_canvas(IMG_SIZE, board["bg_color"])
+        region = board_region(canvas, board)
+
+    used_width = board_width(grid_size, grid_params)
+
+    # Grid lines
+    if line_width > 0:
+        for i in range(grid_size - 1):
+            offset = border_width + (i + 1) * grid_params["cell_width"] + i * line_width
+            # Vertical line
+            fill_rect(
+                region, offset, 0, offset + line_width - 1, used_width - 1, line_color
+            )
+            # Horizontal line
+            fill_rect(
+                region, 0, offset, used_width - 1, offset + line_width - 1, line_color
+            )
+
+    # Border
+    if border_width > 0:
+        outline_rect(
+            region,
+            0,
+            0,
+            used_width - 1,
+            used_width - 1,
+            board["border_color"],
+            border_width,
+        )
+
+    # Cached and shared between requests, so never modified in place
+    canvas.flags.writeable = False
+    return canvas
+
+
+def get_skeleton(board):
+    key = skeleton_key(board)
+    skeleton = skeleton_cache.get(key)
+    if skeleton is None:
+        skeleton = render_skeleton(board)
+        skeleton_cache.put(key, skeleton)
+    return skeleton
+
+
+def mark_placement(placement):
+    # Only placement names draw anything; other JSON values stay out of the mask caches
+    return placement if isinstance(placement, str) else None
+
+
+def board_cells(board):
+    # {(row, column): (sprites, marks)} of every occupied cell, both in item order
+    team_marks = {
+        name: (mark_placement(team["placement"]), team["color"])
+        for name, team in board["team_info"].items()
+    }
+    # Item / Block completion
+    draw_marks = board["grid_params"]["padding"] > 0
+
+    cells = {}
+    for item in board_items(board):
+        cell = (item["row"], item["column"])
+        sprites, marks = cells.get(cell, ((), ()))
+        if draw_marks:
+            marks += tuple(team_marks[team] for team in completed_teams_of(item))
+        cells[cell] = (sprites + (item["sprite"],), marks)
+    return cells
+
+
+def get_tile(board, sprites, marks):
+    grid_params = board["grid_params"]
+    asset_width = grid_params["asset_width"]
+    key = (
+        sprites,
+        marks,
+        grid_params["cell_width"],
+        grid_params["padding"],
+        asset_width,
+        board["bg_color"],
+    )
+    tile = tile_cache.get(key)
+    if tile is not None:
+        return tile
+
+    # Add images from textures
+    layers = []
+    with stage("textures"):
+        for texture_name in sprites:
+            # Preloaded RGBA texture, scaled to the asset width
+            sprite = get_sprite_layers(texture_name, asset_width)
+
+            if sprite is None:
+                msg = f"Invalid texture {texture_name} provided."
+                raise ValueError(msg)
+
+            layers.append(sprite)
+
+    with stage("draw"):
+        tile = cell_tile(
+            board["bg_color"],
+            layers,
+            marks,
+            grid_params["cell_width"],
+            grid_params["padding"],
+        )
+    tile_cache.put(key, tile)
+    return tile
+
+
+def render_base_board(board, cells):
+    # The skeleton with a blit of every occupied cell's unmarked tile
+    with stage("draw"):
+        canvas = get_skeleton(board).copy()
+
+    tiles = [
+        (row, column, get_tile(board, sprites, ()))
+        for (row, column), (sprites, _) in cells.items()
+    ]
+
+    with stage("draw"):
+        region = board_region(canvas, board)
+        blit_tiles(region, board["grid_size"], board["grid_params"], tiles)
+
+    canvas.flags.writeable = False
+    return canvas
+
+
+def draw_completions(canvas, board, cells):
+    # Completed cells are replaced by their marked tiles
+    tiles = [
+        (row, column, get_tile(board, sprites, marks))
+        for (row, column), (sprites, marks) in cells.items()
+        if marks
+    ]
+    with stage("draw"):
+        blit_tiles(canvas, board["grid_size"], board["grid_params"], tiles)
+
+
+def render_board(board):
+    # Completion marks and the bingo line are drawn on a copy of the cached base
+    cells = board_cells(board)
+    key = base_board_key(board)
+    base_canvas = base_board_cache.get(key)
+    if base_canvas is None:
+        base_canvas = render_base_board(board, cells)
+        base_board_cache.put(key, base_canvas)
+
+    with stage("draw"):
+        canvas = base_canvas.copy()
+        region = board_region(canvas, board)
+
+    draw_completions(region, board, cells)
+
+    with stage("draw"):
+        # The bingo line is diagonal geometry, so it is still drawn by Pillow, on an
+        # image of just the board region
+        board_image = Image.fromarray(region)
+        draw = ImageDraw.Draw(board_image)
+
+    # Detect and draw bingo
+    with stage("bingo"):
+        bingo_report = detect_bingo(
+            board["grid_size"],
+            board["items"],
+            draw,
+            board["grid_params"],
+            board["team_info"],
+        )
+        if bingo_report["winner"] is not None:
+            region[...] = np.asarray(board_image)
+
+    return Image.fromarray(canvas), bingo_report
+
+
+def encode_image(image, profile=OUTPUT_PROFILE):
+    return encode(image, profile)
+
+
+def output_filename(board, profile):
+    with stage("validate"):
+        validate_items(board)
+
+        # Identical boards map to the same file, so a repeat skips rendering entirely
+        return f"{output_key(board, profile)}.{PROFILES[profile]['extension']}"
+
+
+def render_output(board, profile, map_colors=False):
+    image, bingo_report = render_board(board)
+    with stage("encode"):
+        image_data = encode_image(image, profile)
+    map_data = None
+    if map_colors:
+        with stage("map_colors"):
+            map_data = to_map_colors(image)
+    return image_data, bingo_report, map_data
+
+
+def board_map_colors(board):
+    # For boards whose encoded image is already stored: pixels only, nothing is encoded
+    image, _ = render_board(board)
+    with stage("map_colors"):
+        return to_map_colors(image)
+
+
+def board_bingo(board):
+    with stage("bingo"):
+        return detect_bingo(
+            board["grid_size"],
+            board["items"],
+            None,
+            board["grid_params"],
+            board["team_info"],
+        )
+
+
+def score_board(board):
+    # Bingo state only: no layout, pixels or files, so it is cheap enough to poll
+    with stage("validate"):
+        validate_items(board)
+
+    with stage("bingo"):
+        report = evaluate(board["grid_size"], board["items"], board["team_info"])
+
+    return {
+        "bingo": report["winner"],
+        "completed": report["completed"],
+        "bingo_lines": report["lines"],
+        "near_complete": report["near_complete"],
+    }
+
+
+def output_result(filename, bingo_report, profile, image_data=None, map_data=None):
+    result = {
+        "map_url": f"/public/{filename}" if filename else None,
+        "bingo": bingo_report["winner"],
+        "bingo_lines": bingo_report["lines"],
+        "near_complete": bingo_report["near_complete"],
+        "profile": profile,
+        "content_type": PROFILES[profile]["content_type"],
+    }
+    if image_data is not None:
+        result["image"] = image_data
+    if map_data is not None:
+        result["map_colors"] = map_data
+    return result
+
+
+def generate_steps(board, persist, include_image, profile, map_colors):
+    # How a board is answered, from the local output, the shared cache or a render. Every
+    # blocking call is yielded as (kind, fn, args) and its result sent back in: "io" for
+    # file and network access, "render" for pixels and encoding. generate_board runs
+    # the steps inline, the ASGI app on threads and the render engine
+    filename = output_filename(board, profile)
+
+    image_data = None
+    cached = False
+    if persist:
+        with stage("lookup"):
+            if include_image:
+                image_data = yield ("io", output_store.read, (filename,))
+                cached = image_data is not None
+            else:
+                cached = yield ("io", output_store.lookup, (filename,))
+
+    # Another replica may have rendered the same board already
+    if not cached and shared_cache is not None:
+        with stage("shared_lookup"):
+            image_data = yield ("io", shared_cache.get, (filename,))
+        cached = image_data is not None
+        if cached and persist:
+            with stage("write"):
+                yield ("io", output_store.write, (filename, image_data))
+
+    map_data = None
+    if cached:
+        bingo_report = board_bingo(board)
+        if map_colors:
+            map_data = yield ("render", board_map_colors, (board,))
+    else:
+        image_data, bingo_report, map_data = yield (
+            "render",
+            render_output,
+            (board, profile, map_colors),
+        )
+        if shared_cache is not None:
+            with stage("shared_write"):
+                yield ("io", shared_cache.put, (filename, image_data))
+
+        # Save image
+        if persist:
+            with stage("write"):
+                yield ("io", output_store.write, (filename, image_data))
+
+    return output_result(
+        filename if persist else None,
+        bingo_report,
+        profile,
+        image_data if include_image else None,
+        map_data,
+    )
+
+
+def generate_board(
+    board,
+    persist=True,
+    include_image=False,
+    profile=OUTPUT_PROFILE,
+    map_colors=False,
+):
+    steps = generate_steps(board, persist, include_image, profile, map_colors)
+    result = None
+    try:
+        while True:
+            _, fn, args = steps.send(result)
+            result = fn(*args)
+    except StopIteration as e:
+        return e.value
+
+
+def cache_stats():
+    return {
+        "textures": texture_store.stats(),
+        "scaled_textures": scaled_texture_cache.stats(),
+        "skeletons": skeleton_cache.stats(),
+        "base_boards": base_board_cache.stats(),
+        "tiles": tile_cache.stats(),
+        "output": output_store.stats(),
+        "shared": shared_cache.stats() if shared_cache is not None else None,
+        "layout_table": layout_table.stats(),
+    }
+
+
+def clear_caches():
+    scaled_texture_cache.clear()
+    skeleton_cache.clear()
+    base_board_cache.clear()
+    tile_cache.clear()
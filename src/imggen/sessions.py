@@ -0,0 +1,467 @@
+import fcntl
+import json
+import os
+import re
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+
+from cache import LRUCache
+from renderer import board_items, parse_board, validate_items
+
+SESSION_ID = re.compile(r"[A-Za-z0-9_-]{1,64}")
+SNAPSHOT_KEYS = ("settings", "items")
+
+
+class SessionNotFoundError(Exception):
+    pass
+
+
+def not_found(session_id):
+    msg = f"Session {session_id} not found."
+    return SessionNotFoundError(msg)
+
+
+def board_data(data):
+    # The settings and items of a /generate body, in either of its two shapes
+    settings = data.get("settings", {})
+    items = data.get("items", [])
+    if not settings and not items:
+        settings = data.get("map_raw", {}).get("settings", {})
+        items = data.get("map_raw", {}).get("items", [])
+    # A private copy: deltas are applied to these items in place
+    return json.loads(json.dumps({"settings": settings, "items": items}))
+
+
+def index_cells(grid_size, items):
+    cells = {}
+    for item in board_items({"grid_size": grid_size, "items": items}):
+        cells.setdefault((item["row"], item["column"]), []).append(item)
+    return cells
+
+
+def set_completed(items, team, completed):
+    for item in items:
+        if not isinstance(item.get("completed"), dict):
+            item["completed"] = {}
+        item["completed"][team] = completed
+
+
+def trim_history(data, grid_size, max_history, cells=None):
+    # Oldest changes beyond the limit are folded into the initial board; returns the
+    # initial items by cell, so callers can keep them for the next trim
+    history = data["history"]
+    while max_history and len(history) > max_history:
+        if cells is None:
+            cells = index_cells(grid_size, data["initial_items"])
+        for change in history.pop(0):
+            cell = (change["row"], change["column"])
+            set_completed(cells[cell], change["team"], change["completed"])
+    return cells
+
+
+class Session:
+    # With a session directory the history lives in files (see SessionStore), so only
+    # in-memory sessions record it here
+    def __init__(self, session_id, data, version, record_history=True):
+        self.id = session_id
+        self.lock = threading.Lock()
+        self.record_history = record_history
+        # Snapshot this session was loaded from and how far its log has been replayed
+        self.snapshot_stat = None
+        self.snapshot_version = version
+        self.log_offset = 0
+        self.load(data, version)
+
+    def load(self, data, version):
+        self.data = data
+        self.version = version
+        self.board = parse_board(data)
+        # Items by cell, so a delta touches only its cell no matter the board size
+        self.cells = index_cells(self.board["grid_size"], self.board["items"])
+        # The board before the oldest recorded change, replayed by timelapse exports
+        if self.record_history:
+            if "initial_items" not in data:
+                data["initial_items"] = json.loads(json.dumps(data["items"]))
+            data.setdefault("history", [])
+        self.initial_cells = None
+
+    def resolve(self, change):
+        # The items a change touches, checked before anything is modified
+        if not isinstance(change, dict):
+            msg = "Expected each change to be an object."
+            raise ValueError(msg)
+
+        row = change.get("row")
+        column = change.get("column")
+        team = change.get("team")
+        completed = change.get("completed", True)
+        if not isinstance(completed, bool):
+            msg = "completed must be a boolean."
+            raise ValueError(msg)
+
+        items = self.cells.get((row, column))
+        if not items:
+            msg = f"No item at row {row}, column {column}."
+            raise ValueError(msg)
+
+        team_info = self.board["team_info"].get(team)
+        if team_info is None or not team_info["color"] or not team_info["placement"]:
+            msg = f"Invalid team key entered ({team} in change for [row {row}, column {column}])."
+            raise ValueError(msg)
+
+        change = {"row": row, "column": column, "team": team, "completed": completed}
+        return items, change
+
+    def apply(self, changes, max_history=0):
+        # All or nothing: a bad change leaves the session untouched; returns the
+        # normalized changes
+        resolved = [self.resolve(change) for change in changes]
+        for items, change in resolved:
+            set_completed(items, change["team"], change["completed"])
+
+        changes = [change for _, change in resolved]
+        if self.record_history:
+            self.data["history"].append(changes)
+            self.initial_cells = trim_history(
+                self.data, self.board["grid_size"], max_history, self.initial_cells
+            )
+        return changes
+
+    def timeline(self):
+        # Starting version, settings, items before the first recorded change and the
+        # changes since, copied so they can be replayed outside the lock
+        history = self.data["history"]
+        return (
+            self.version - len(history),
+            json.loads(json.dumps(self.data["settings"])),
+            json.loads(json.dumps(self.data["initial_items"])),
+            json.loads(json.dumps(history)),
+        )
+
+    def render_board(self):
+        # Copy of the items, so rendering never sees a later delta half applied
+        items = [
+            (
+                {**item, "completed": dict(item["completed"])}
+                if isinstance(item.get("completed"), dict)
+                else item
+            )
+            for item in self.board["items"]
+        ]
+        return dict(self.board, items=items)
+
+
+class SessionStore:
+    # Live boards by session id, in memory and optionally kept in a directory that every
+    # server process shares. There a session is a snapshot of the board (<id>.json), an
+    # append-only log of the deltas since (<id>.log) and the history for timelapse
+    # exports (<id>.history); every compact_every versions the log is folded into the
+    # snapshot and the history
+    def __init__(
+        self,
+        directory,
+        maxsize: int,
+        max_age: int,
+        gc_interval: int,
+        max_history: int = 0,
+        compact_every: int = 64,
+    ):
+        self.directory = directory
+        self.sessions = LRUCache(maxsize)
+        self.max_history = max_history
+        self.compact_every = max(1, compact_every)
+        self.max_age = max_age
+        self.gc_interval = gc_interval
+        self.lock = threading.Lock()
+        self.last_gc = 0.0
+        self.created = 0
+        self.updates = 0
+        self.reloads = 0
+        self.replayed = 0
+        self.compactions = 0
+
+    def path(self, session_id, extension):
+        return os.path.join(self.directory, f"{session_id}.{extension}")
+
+    @contextmanager
+    def locked(self, session_id, create=False):
+        # flock is held per open file, so it also serializes threads of one process
+        if self.directory is None:
+            yield
+            return
+        if not create and not os.path.exists(self.path(session_id, "json")):
+            # No lock files for ids that were never created
+            raise not_found(session_id)
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path(session_id, "lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def write(path, data):
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as temp_file:
+            temp_file.write(json.dumps(data, separators=(",", ":")))
+        os.replace(temp_path, path)
+
+    def save(self, session):
+        snapshot = {"session_id": session.id, "version": session.version}
+        snapshot.update({key: session.data[key] for key in SNAPSHOT_KEYS})
+        self.write(self.path(session.id, "json"), snapshot)
+        session.snapshot_stat = self.snapshot_stat(session.id)
+        session.snapshot_version = session.version
+
+    def append(self, session, changes):
+        # One line per version; writers hold the session's file lock, so the log ends
+        # where this session's replay stopped
+        entry = {"version": session.version, "changes": changes}
+        with open(self.path(session.id, "log"), "a") as log_file:
+            log_file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+            session.log_offset = log_file.tell()
+
+    def read_log(self, session_id, offset=0):
+        # Log entries from offset on and the offset after them; a line cut short by a
+        # crash is skipped
+        try:
+            with open(self.path(session_id, "log"), "rb") as log_file:
+                log_file.seek(offset)
+                data = log_file.read()
+        except FileNotFoundError:
+            return [], 0
+        entries = []
+        for line in data.splitlines():
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+        return entries, offset + len(data)
+
+    def read_history(self, session_id):
+        try:
+            with open(self.path(session_id, "history")) as history_file:
+                return json.load(history_file)
+        except FileNotFoundError:
+            # Snapshots written before the history moved out carry it themselves
+            with open(self.path(session_id, "json")) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+            return {
+                "version": snapshot["version"],
+                "initial_items": snapshot.get("initial_items", snapshot["items"]),
+                "history": snapshot.get("history", []),
+            }
+
+    def history(self, session):
+        # The history file with the log entries it does not contain yet
+        history = self.read_history(session.id)
+        for entry in self.read_log(session.id)[0]:
+            if entry["version"] > history["version"]:
+                history["history"].append(entry["changes"])
+                history["version"] = entry["version"]
+        trim_history(history, session.board["grid_size"], self.max_history)
+        return history
+
+    def compact(self, session):
+        # History first: every file records its version, so a crash between the writes
+        # leaves entries that readers skip rather than apply twice
+        self.write(self.path(session.id, "history"), self.history(session))
+        self.save(session)
+        with open(self.path(session.id, "log"), "w"):
+            pass
+        session.log_offset = 0
+        with self.lock:
+            self.compactions += 1
+
+    def snapshot_stat(self, session_id):
+        try:
+            stat = os.stat(self.path(session_id, "json"))
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def current(self, session_id):
+        # The cached session, reloaded when another process has compacted it and brought
+        # up to date with the log entries other processes appended since
+        session = self.sessions.get(session_id)
+        if self.directory is None:
+            if session is None:
+                raise not_found(session_id)
+            return session
+
+        stat = self.snapshot_stat(session_id)
+        if stat is None:
+            self.sessions.pop(session_id)
+            raise not_found(session_id)
+        if session is None or session.snapshot_stat != stat:
+            with open(self.path(session_id, "json")) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+            data = {key: snapshot[key] for key in SNAPSHOT_KEYS}
+            if session is None:
+                session = Session(session_id, data, snapshot["version"], False)
+                self.sessions.put(session_id, session)
+            else:
+                session.load(data, snapshot["version"])
+            session.snapshot_stat = stat
+            session.snapshot_version = snapshot["version"]
+            session.log_offset = 0
+            with self.lock:
+                self.reloads += 1
+
+        entries, session.log_offset = self.read_log(session_id, session.log_offset)
+        with session.lock:
+            for entry in entries:
+                if entry["version"] > session.version:
+                    session.apply(entry["changes"])
+                    session.version = entry["version"]
+        if entries:
+            with self.lock:
+                self.replayed += len(entries)
+        return session
+
+    def validate_id(self, session_id):
+        if not SESSION_ID.fullmatch(session_id):
+            raise not_found(session_id)
+
+    def create(self, data):
+        session = Session(
+            secrets.token_urlsafe(12), board_data(data), 1, self.directory is None
+        )
+        # Rejected up front, rather than on every render of the session
+        validate_items(session.board)
+
+        if self.directory is not None:
+            with self.locked(session.id, create=True):
+                history = {
+                    "version": session.version,
+                    "initial_items": session.data["items"],
+                    "history": [],
+                }
+                self.write(self.path(session.id, "history"), history)
+                self.save(session)
+        self.sessions.put(session.id, session)
+        with self.lock:
+            self.created += 1
+        self.maybe_collect_garbage()
+        return session.id, session.version, session.render_board()
+
+    def get(self, session_id):
+        self.validate_id(session_id)
+        with self.locked(session_id):
+            session = self.current(session_id)
+            with session.lock:
+                return session.version, session.render_board()
+
+    def update(self, session_id, changes):
+        if not isinstance(changes, list):
+            msg = "Expected a list of changes ('changes' section)."
+            raise ValueError(msg)
+
+        self.validate_id(session_id)
+        with self.locked(session_id):
+            session = self.current(session_id)
+            with session.lock:
+                changes = session.apply(changes, self.max_history)
+                session.version += 1
+                if self.directory is not None:
+                    self.append(session, changes)
+                    if session.version - session.snapshot_version >= self.compact_every:
+                        self.compact(session)
+                version, board = session.version, session.render_board()
+
+        with self.lock:
+            self.updates += 1
+        return version, board
+
+    def timeline(self, session_id):
+        self.validate_id(session_id)
+        with self.locked(session_id):
+            session = self.current(session_id)
+            if self.directory is None:
+                with session.lock:
+                    return session.timeline()
+            history = self.history(session)
+            with session.lock:
+                settings = json.loads(json.dumps(session.data["settings"]))
+            return (
+                history["version"] - len(history["history"]),
+                settings,
+                history["initial_items"],
+                history["history"],
+            )
+
+    def delete(self, session_id):
+        self.validate_id(session_id)
+        with self.locked(session_id):
+            if self.directory is not None:
+                if not self.remove(self.path(session_id, "json")):
+                    self.sessions.pop(session_id)
+                    raise not_found(session_id)
+            elif self.sessions.get(session_id) is None:
+                raise not_found(session_id)
+            self.sessions.pop(session_id)
+            if self.directory is not None:
+                self.remove(self.path(session_id, "log"))
+                self.remove(self.path(session_id, "history"))
+        if self.directory is not None:
+            self.remove(self.path(session_id, "lock"))
+
+    def maybe_collect_garbage(self):
+        if self.directory is None or not self.max_age:
+            return
+        now = time.time()
+        with self.lock:
+            if now - self.last_gc < self.gc_interval:
+                return
+            self.last_gc = now
+        self.collect_garbage(now)
+
+    def collect_garbage(self, now=None):
+        # Sessions nobody has updated within max_age; updates since the last compaction
+        # only touch the log
+        now = time.time() if now is None else now
+        removed = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".json"):
+                    continue
+                session_id = entry.name[: -len(".json")]
+                try:
+                    if now - entry.stat().st_mtime <= self.max_age:
+                        continue
+                    log_path = self.path(session_id, "log")
+                    if now - os.stat(log_path).st_mtime <= self.max_age:
+                        continue
+                except FileNotFoundError:
+                    pass
+                self.sessions.pop(session_id)
+                if self.remove(entry.path):
+                    for extension in ("log", "history", "lock"):
+                        self.remove(self.path(session_id, extension))
+                    removed += 1
+        return removed
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def stats(self):
+        return {
+            "cache": self.sessions.stats(),
+            "snapshots": self.directory is not None,
+            "created": self.created,
+            "updates": self.updates,
+            "reloads": self.reloads,
+            "replayed": self.replayed,
+            "compactions": self.compactions,
+            "compact_every": self.compact_every,
+            "max_history": self.max_history,
+            "max_age": self.max_age,
+        }
@@ -0,0 +1,231 @@
+import os
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+
+from storage import OutputStore
+
+
+class BackendError(Exception):
+    pass
+
+
+class FileBackend:
+    # Entries are files on a volume every replica mounts, named like the output files and
+    # kept with the same retention: ttl counts from the last use, oldest go first past
+    # max_bytes
+    def __init__(self, directory: str, ttl: int, max_bytes: int, gc_interval: int):
+        self.ttl = ttl
+        self.store = OutputStore(directory, ttl, max_bytes, gc_interval)
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError:
+            # An unmounted volume only opens the circuit once it is used
+            pass
+
+    def get(self, key: str) -> bytes | None:
+        try:
+            mtime = os.stat(self.store.path(key)).st_mtime
+        except FileNotFoundError:
+            return None
+        if self.ttl and time.time() - mtime > self.ttl:
+            return None
+        return self.store.read(key)
+
+    def set(self, key: str, value: bytes) -> None:
+        self.store.write(key, value)
+
+
+def encode_command(args) -> bytes:
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode()
+        elif isinstance(arg, int):
+            arg = b"%d" % arg
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+def read_reply(reader):
+    line = reader.readline()
+    if not line.endswith(b"\r\n"):
+        msg = "Connection closed by the key-value server."
+        raise ConnectionError(msg)
+
+    kind, payload = line[:1], line[1:-2]
+    if kind == b"+":
+        return payload
+    if kind == b"-":
+        raise BackendError(payload.decode(errors="replace"))
+    if kind == b":":
+        return int(payload)
+    if kind == b"$":
+        length = int(payload)
+        if length < 0:
+            return None
+        data = reader.read(length + 2)
+        if len(data) != length + 2:
+            msg = "Connection closed by the key-value server."
+            raise ConnectionError(msg)
+        return data[:-2]
+    if kind == b"*":
+        count = int(payload)
+        if count < 0:
+            return None
+        return [read_reply(reader) for _ in range(count)]
+    msg = f"Unexpected reply from the key-value server: {line[:32]!r}"
+    raise BackendError(msg)
+
+
+class RespBackend:
+    # Minimal RESP client for a Redis compatible key-value server, one connection per
+    # thread. Reads refresh the ttl like file access does; the size limit is the
+    # server's own (maxmemory with an LRU policy)
+    def __init__(self, host: str, port: int, ttl: int, timeout: float, prefix: str):
+        self.host = host
+        self.port = port
+        self.ttl = ttl
+        self.timeout = timeout
+        self.prefix = prefix
+        self.local = threading.local()
+
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            sock = socket.create_connection((self.host, self.port), self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = self.local.connection = (sock, sock.makefile("rb"))
+        return connection
+
+    def close(self) -> None:
+        connection = getattr(self.local, "connection", None)
+        self.local.connection = None
+        if connection is not None:
+            connection[1].close()
+            connection[0].close()
+
+    def command(self, *args):
+        sock, reader = self.connection()
+        try:
+            sock.sendall(encode_command(args))
+            return read_reply(reader)
+        except BaseException:
+            # A half-read reply would be taken as the answer to the next command
+            self.close()
+            raise
+
+    def get(self, key: str) -> bytes | None:
+        if self.ttl:
+            return self.command("GETEX", self.prefix + key, "PX", self.ttl * 1000)
+        return self.command("GET", self.prefix + key)
+
+    def set(self, key: str, value: bytes) -> None:
+        args = ["SET", self.prefix + key, value]
+        if self.ttl:
+            args += ["PX", self.ttl * 1000]
+        reply = self.command(*args)
+        if reply != b"OK":
+            msg = f"Unexpected reply to SET: {reply!r}"
+            raise BackendError(msg)
+
+
+class SharedCache:
+    # Rendered outputs shared between replicas. A backend failure opens the circuit for
+    # retry_after seconds: lookups miss and writes are dropped, so boards render locally
+    def __init__(self, backend, max_entry_bytes: int, retry_after: float):
+        self.backend = backend
+        self.max_entry_bytes = max_entry_bytes
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.open_until = 0.0
+        self.last_error = None
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.oversized = 0
+        self.errors = 0
+        self.skipped = 0
+
+    def available(self) -> bool:
+        with self.lock:
+            if time.monotonic() < self.open_until:
+                self.skipped += 1
+                return False
+            return True
+
+    def failed(self, error: Exception) -> None:
+        with self.lock:
+            self.errors += 1
+            self.open_until = time.monotonic() + self.retry_after
+            self.last_error = f"{type(error).__name__}: {error}"
+
+    def get(self, key: str) -> bytes | None:
+        if not self.available():
+            return None
+        try:
+            value = self.backend.get(key)
+        except (OSError, ValueError, BackendError) as e:
+            self.failed(e)
+            return None
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def put(self, key: str, value: bytes) -> None:
+        if self.max_entry_bytes and len(value) > self.max_entry_bytes:
+            with self.lock:
+                self.oversized += 1
+            return
+        if not self.available():
+            return
+        try:
+            self.backend.set(key, value)
+        except (OSError, ValueError, BackendError) as e:
+            self.failed(e)
+            return
+        with self.lock:
+            self.writes += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__,
+            "circuit": "open" if time.monotonic() < self.open_until else "closed",
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "writes": self.writes,
+            "oversized": self.oversized,
+            "errors": self.errors,
+            "skipped": self.skipped,
+            "last_error": self.last_error,
+        }
+
+
+def open_shared_cache(
+    url, ttl, max_bytes, max_entry_bytes, timeout, retry_after, gc_interval
+):
+    # file:///mnt/imggen-cache or redis://host:port; None when no URL is configured
+    if not url:
+        return None
+
+    parts = urlsplit(url)
+    if parts.scheme == "file" and parts.path:
+        backend = FileBackend(parts.path, ttl, max_bytes, gc_interval)
+    elif parts.scheme == "redis":
+        backend = RespBackend(
+            parts.hostname or "127.0.0.1",
+            parts.port or 6379,
+            ttl,
+            timeout,
+            "imggen:output:",
+        )
+    else:
+        msg = f"Invalid shared cache URL '{url}' (expected file:///path or redis://host:port)."
+        raise ValueError(msg)
+    return SharedCache(backend, max_entry_bytes, retry_after)
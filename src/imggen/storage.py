@@ -0,0 +1,171 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger("imggen")
+
+OUTPUT_EXTENSIONS = (".png", ".webp")
+# Held by the process that collects; its mtime is when the directory was last collected
+GC_LOCK_FILE = ".gc.lock"
+
+
+def content_key(normalized: dict) -> str:
+    encoded = json.dumps(normalized, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+class OutputStore:
+    # Content-addressed files in the public directory with age/size based retention
+    def __init__(self, directory: str, max_age: int, max_bytes: int, gc_interval: int):
+        self.directory = directory
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.gc_interval = gc_interval
+        self.lock = threading.Lock()
+        self.last_gc = 0.0
+        self.writes = 0
+        self.dedup_hits = 0
+        self.gc_runs = 0
+        self.removed_files = 0
+        self.removed_bytes = 0
+
+    def path(self, filename: str) -> str:
+        return os.path.join(self.directory, filename)
+
+    def lookup(self, filename: str) -> bool:
+        # Touch on hit so retention treats the file as recently used
+        try:
+            os.utime(self.path(filename))
+        except FileNotFoundError:
+            return False
+        with self.lock:
+            self.dedup_hits += 1
+        return True
+
+    def read(self, filename: str) -> bytes | None:
+        try:
+            with open(self.path(filename), "rb") as output_file:
+                data = output_file.read()
+        except FileNotFoundError:
+            return None
+        os.utime(self.path(filename))
+        with self.lock:
+            self.dedup_hits += 1
+        return data
+
+    def write(self, filename: str, data: bytes) -> None:
+        # Write to a temp file first so concurrent workers never serve a partial image
+        temp_path = self.path(f".{filename}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(temp_path, "wb") as output_file:
+            output_file.write(data)
+        os.replace(temp_path, self.path(filename))
+        with self.lock:
+            self.writes += 1
+        self.maybe_collect_garbage()
+
+    def maybe_collect_garbage(self) -> None:
+        if not self.max_age and not self.max_bytes:
+            return
+        now = time.time()
+        with self.lock:
+            if now - self.last_gc < self.gc_interval:
+                return
+            self.last_gc = now
+        # The scan runs off the request path, started lazily so no thread exists in a
+        # process before a fork
+        threading.Thread(
+            target=self.collect_once, name="imggen-output-gc", daemon=True
+        ).start()
+
+    def collect_once(self) -> None:
+        # Every worker and render process shares the directory, so only the one holding
+        # the lock scans it, and only if nobody has within the interval
+        lock_path = self.path(GC_LOCK_FILE)
+        try:
+            collected_before = os.path.exists(lock_path)
+            with open(lock_path, "a+") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return
+                try:
+                    now = time.time()
+                    last_gc = os.fstat(lock_file.fileno()).st_mtime
+                    if collected_before and now - last_gc < self.gc_interval:
+                        return
+                    os.utime(lock_file.fileno())
+                    self.collect_garbage(now)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        except OSError as e:
+            log.warning("Output garbage collection failed: %s", e)
+
+    def collect_garbage(self, now: float | None = None) -> dict:
+        now = time.time() if now is None else now
+        files = []
+
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.startswith(".") or not entry.name.endswith(
+                    OUTPUT_EXTENSIONS
+                ):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        removed_files = 0
+        removed_bytes = 0
+        kept = []
+
+        for mtime, size, path in files:
+            if self.max_age and now - mtime > self.max_age:
+                if self.remove(path):
+                    removed_files += 1
+                    removed_bytes += size
+            else:
+                kept.append((mtime, size, path))
+
+        if self.max_bytes:
+            # Oldest first until the directory fits the size budget
+            total = sum(size for _, size, _ in kept)
+            for mtime, size, path in sorted(kept):
+                if total <= self.max_bytes:
+                    break
+                if self.remove(path):
+                    removed_files += 1
+                    removed_bytes += size
+                total -= size
+
+        with self.lock:
+            self.gc_runs += 1
+            self.removed_files += removed_files
+            self.removed_bytes += removed_bytes
+
+        return {"removed_files": removed_files, "removed_bytes": removed_bytes}
+
+    @staticmethod
+    def remove(path: str) -> bool:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "writes": self.writes,
+            "dedup_hits": self.dedup_hits,
+            "gc_runs": self.gc_runs,
+            "removed_files": self.removed_files,
+            "removed_bytes": self.removed_bytes,
+            "max_age": self.max_age,
+            "max_bytes": self.max_bytes,
+            "gc_interval": self.gc_interval,
+        }
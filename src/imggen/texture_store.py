@@ -0,0 +1,118 @@
+import hashlib
+import os
+import resource
+import time
+
+from PIL import Image
+
+from atlas import add_texture, open_atlas, texture_files
+
+
+def resident_memory_bytes() -> int:
+    # Current RSS from /proc, falling back to the peak RSS on other platforms
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class TextureStore:
+    def __init__(self, root: str, atlas_path: str | None = None):
+        self.root = root
+        self.atlas_path = atlas_path
+        self.atlas = None
+        self.source = None
+        # Hash of every texture's name and pixels, part of the output file keys
+        self.content_hash = None
+        self.textures: dict[str, Image.Image] = {}
+        self.decoded_bytes = 0
+        self.load_seconds = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(name: str) -> str:
+        return os.path.normpath(name).replace(os.sep, "/")
+
+    def load(self) -> None:
+        started = time.perf_counter()
+        if not self.load_atlas():
+            self.load_files()
+        self.load_seconds = time.perf_counter() - started
+
+    def load_atlas(self) -> bool:
+        # Pre-decoded pixels written by `python atlas.py`, memory-mapped so every process
+        # shares the same page cache pages; sprites are views into the mapping
+        if self.atlas_path is None:
+            return False
+        opened = open_atlas(self.atlas_path, self.root)
+        if opened is None:
+            return False
+
+        mapped, sprites, content_hash = opened
+        pixels = memoryview(mapped)
+        textures = {}
+        decoded_bytes = 0
+        for name, (offset, width, height) in sprites.items():
+            size = width * height * 4
+            textures[name] = Image.frombuffer(
+                "RGBA",
+                (width, height),
+                pixels[offset : offset + size],
+                "raw",
+                "RGBA",
+                0,
+                1,
+            )
+            decoded_bytes += size
+
+        self.atlas = mapped
+        self.textures = textures
+        self.decoded_bytes = decoded_bytes
+        self.content_hash = content_hash
+        self.source = "atlas"
+        return True
+
+    def load_files(self) -> None:
+        textures = {}
+        decoded_bytes = 0
+        content = hashlib.sha256()
+
+        for name, path in texture_files(self.root):
+            # Decode eagerly so forked workers share the pixel data
+            with Image.open(path) as texture_image:
+                texture = texture_image.convert("RGBA")
+
+            textures[name] = texture
+            decoded_bytes += texture.width * texture.height * 4
+            add_texture(content, name, texture.width, texture.height, texture.tobytes())
+
+        self.textures = textures
+        self.decoded_bytes = decoded_bytes
+        self.content_hash = content.hexdigest()
+        self.source = "files"
+
+    def __contains__(self, name: str) -> bool:
+        return self.normalize(name) in self.textures
+
+    def get(self, name: str) -> Image.Image | None:
+        texture = self.textures.get(self.normalize(name))
+        if texture is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return texture
+
+    def stats(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "textures": len(self.textures),
+            "source": self.source,
+            "content_hash": self.content_hash,
+            "hits": self.hits,
+            "misses": self.misses,
+            "decoded_bytes": self.decoded_bytes,
+            "load_seconds": round(self.load_seconds, 3),
+            "resident_memory_bytes": resident_memory_bytes(),
+        }
@@ -0,0 +1,191 @@
+import io
+import struct
+import zlib
+
+import numpy as np
+from PIL import GifImagePlugin, Image
+
+from encoding import PROFILES, to_palette
+from renderer import render_board
+from sessions import Session
+
+# Animated formats; gif and apng are written frame by frame, webp is encoded at the end
+TIMELAPSE_FORMATS = {
+    "gif": "image/gif",
+    "apng": "image/apng",
+    "webp": "image/webp",
+}
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+class TimelapseTooLongError(ValueError):
+    pass
+
+
+def validate_format(timelapse_format):
+    if timelapse_format not in TIMELAPSE_FORMATS:
+        msg = f"Invalid timelapse format '{timelapse_format}' (expected one of {', '.join(TIMELAPSE_FORMATS)})."
+        raise ValueError(msg)
+    return timelapse_format
+
+
+def frame_count(timeline):
+    return len(timeline[3]) + 1
+
+
+def validate_length(timeline, timelapse_format, max_webp_frames):
+    # webp holds every decoded frame until the end, so its length is capped
+    frames = frame_count(timeline)
+    if timelapse_format == "webp" and max_webp_frames and frames > max_webp_frames:
+        msg = f"Too many frames for a webp timelapse ({frames} > {max_webp_frames}), use gif or apng."
+        raise TimelapseTooLongError(msg)
+    return timeline
+
+
+def session_frames(settings, initial_items, history):
+    # Replays the recorded changes; every frame reuses the cached base board, so only
+    # completion marks and bingo lines are drawn per frame
+    session = Session(None, {"settings": settings, "items": initial_items}, 0, False)
+    yield np.asarray(render_board(session.render_board())[0])
+    for changes in history:
+        session.apply(changes)
+        yield np.asarray(render_board(session.render_board())[0])
+
+
+def changed_box(previous, current):
+    # Bounding box (x0, y0, x1, y1) of the pixels that differ, or None
+    changed = (previous != current).any(axis=2)
+    rows = np.flatnonzero(changed.any(axis=1))
+    if not rows.size:
+        return None
+    columns = np.flatnonzero(changed.any(axis=0))
+    return columns[0], rows[0], columns[-1] + 1, rows[-1] + 1
+
+
+def frame_deltas(frames):
+    # The full first frame, then only the region that changed since the frame before
+    previous = None
+    for frame in frames:
+        if previous is None:
+            box = (0, 0, frame.shape[1], frame.shape[0])
+        else:
+            # An unchanged frame still needs a (one pixel) frame to keep its timing
+            box = changed_box(previous, frame) or (0, 0, 1, 1)
+        x0, y0, x1, y1 = box
+        yield frame[y0:y1, x0:x1], (int(x0), int(y0))
+        previous = frame
+
+
+def gif_image(pixels):
+    # GIF has no partial alpha: frames are written opaque, with an exact palette when
+    # the region uses at most 256 colors
+    opaque = np.array(pixels)
+    opaque[..., 3] = 255
+    image = to_palette(Image.fromarray(opaque))
+    if image is None:
+        image = Image.fromarray(opaque[..., :3]).quantize(256)
+    return image
+
+
+def stream_gif(frames, duration):
+    for index, (pixels, offset) in enumerate(frame_deltas(frames)):
+        image = gif_image(pixels)
+        if index == 0:
+            header, _ = GifImagePlugin.getheader(
+                image, info={"loop": 0, "duration": duration}
+            )
+            yield b"".join(header)
+            options = {}
+        else:
+            # Later frames carry their own palette and stay on screen under the next
+            options = {"include_color_table": True}
+        yield b"".join(
+            GifImagePlugin.getdata(
+                image, offset=offset, duration=duration, disposal=1, **options
+            )
+        )
+    yield b";"
+
+
+def png_chunk(tag, data):
+    body = tag + data
+    return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+
+
+def png_image_data(pixels):
+    # Compressed scanlines of an RGBA image, taken from the IDAT chunks Pillow writes
+    buffer = io.BytesIO()
+    Image.fromarray(np.ascontiguousarray(pixels)).save(buffer, "PNG")
+    png = buffer.getvalue()
+
+    data = []
+    position = len(PNG_SIGNATURE)
+    while position < len(png):
+        (length,) = struct.unpack(">I", png[position : position + 4])
+        tag = png[position + 4 : position + 8]
+        if tag == b"IDAT":
+            data.append(png[position + 8 : position + 8 + length])
+        position += length + 12
+    return b"".join(data)
+
+
+def stream_apng(frames, duration, frame_count):
+    # APNG only needs the frame count up front, so frames are encoded as they come
+    sequence = 0
+    for index, (pixels, (x, y)) in enumerate(frame_deltas(frames)):
+        height, width = pixels.shape[:2]
+        if index == 0:
+            yield PNG_SIGNATURE + png_chunk(
+                b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+            )
+            yield png_chunk(b"acTL", struct.pack(">II", frame_count, 0))
+
+        # Frames replace their region (blend source) and are kept (dispose none)
+        control = struct.pack(
+            ">IIIIIHHBB", sequence, width, height, x, y, duration, 1000, 0, 0
+        )
+        sequence += 1
+        chunks = [png_chunk(b"fcTL", control)]
+
+        data = png_image_data(pixels)
+        if index == 0:
+            chunks.append(png_chunk(b"IDAT", data))
+        else:
+            chunks.append(png_chunk(b"fdAT", struct.pack(">I", sequence) + data))
+            sequence += 1
+        yield b"".join(chunks)
+    yield png_chunk(b"IEND", b"")
+
+
+def encode_webp(frames, duration):
+    # libwebp stores sub-frame deltas itself, but Pillow hands it every frame at once
+    images = [Image.fromarray(frame) for frame in frames]
+    buffer = io.BytesIO()
+    images[0].save(
+        buffer,
+        "WEBP",
+        save_all=True,
+        append_images=images[1:],
+        duration=duration,
+        loop=0,
+        **PROFILES["webp"]["options"],
+    )
+    yield buffer.getvalue()
+
+
+def export(timeline, timelapse_format, duration):
+    # Chunks of the encoded animation, from a session timeline
+    _, settings, initial_items, history = timeline
+    frames = session_frames(settings, initial_items, history)
+    if timelapse_format == "gif":
+        return stream_gif(frames, duration)
+    if timelapse_format == "apng":
+        return stream_apng(frames, duration, frame_count(timeline))
+    return encode_webp(frames, duration)
+
+
+def render_timelapse(timeline, timelapse_format, duration):
+    # One render job per export: frames are drawn and encoded in the pool process, and
+    # only the encoded animation comes back
+    return b"".join(export(timeline, timelapse_format, duration))